@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+
+"""Offline benchmarks for content_downloader.py and software-downloader.py
+
+Runs against a local HTTP stand-in for support.paloaltonetworks.com and
+downloads.paloaltonetworks.com. The stand-in serves the SSO login forms,
+the DynamicUpdates and SoftwareUpdates pages and the files they link to,
+honoring Range requests. The listing pages are generated, or replayed
+from fixtures recorded from the real portal with --record. The stand-in
+can limit the throughput of each connection to mimic the per-connection
+bottleneck of the real download servers.
+
+Benchmarks:
+  check     login and check latency, logged in and with the listing cache
+  parse     link scanning and generate_release_list() on a large listing
+  download  single stream against segmented download throughput
+  startup   wall time of a content_downloader.py run that finds nothing new
+  push      download-to-installed time of pushing the content packages to
+            mock PAN-OS XML API targets, pipelined against one at a time
+
+Works with python 2.7 only.
+"""
+
+from __future__ import print_function
+import os
+import re
+import imp
+import time
+import random
+import sys
+import shutil
+import subprocess
+import argparse
+import tempfile
+import threading
+import StringIO
+import hashlib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from content_downloader import (ContentDownloader, LinkScanner, PageCache, PushPipeline, PushTarget, get_config,
+                                load_config)
+
+PORTAL_DOWNLOAD_URL = "https://downloads.paloaltonetworks.com/"
+# Fixture files of the recorded listing pages
+FIXTURES = {
+    "/Updates/DynamicUpdates": "DynamicUpdates.html",
+    "/Updates/SoftwareUpdates/": "SoftwareUpdates.html",
+}
+SESSION_COOKIE = "benchmark-session=1"
+
+SSO_PAGE = """<html><body><h1>Single Sign On</h1>
+<form method="post" action="/login">
+<input type="text" name="Email"><input type="password" name="Password">
+<input type="submit" value="Sign In">
+</form></body></html>"""
+
+RESUME_PAGE = """<html><body><p>Since your browser does not support JavaScript, you must press the
+Resume button once to proceed.</p>
+<form method="post" action="/resume">
+<input type="hidden" name="SAMLResponse" value="benchmark"><input type="submit" value="Resume">
+</form></body></html>"""
+
+WELCOME_PAGE = "<html><body><h2>Welcome</h2></body></html>"
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the portal pages, and server.data at every other path"""
+
+    protocol_version = "HTTP/1.1"
+    # Buffer the status line and headers, so small responses on a kept
+    # alive connection aren't delayed by Nagle's algorithm
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/":
+            return self._send_page(SSO_PAGE)
+        if path in FIXTURES:
+            if SESSION_COOKIE not in (self.headers.get("Cookie") or ""):
+                return self._send_page(SSO_PAGE)
+            page = self.server.pages[path]
+            etag = '"%x"' % (hash(page) & 0xffffffff)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            return self._send_page(page, [("ETag", etag)])
+        self._send_data()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path == "/login":
+            return self._send_page(RESUME_PAGE)
+        if self.path == "/resume":
+            self.server.logins += 1
+            return self._send_page(WELCOME_PAGE, [("Set-Cookie", SESSION_COOKIE + "; Path=/")])
+        self.send_error(404)
+
+    def _send_page(self, page, headers=()):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(page)
+
+    def _send_data(self):
+        data = self.server.data
+        start, end = 0, len(data) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range") or "")
+        if match is not None and self.server.ranges:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(data))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        self._send_throttled(data, start, end + 1)
+
+    def _send_throttled(self, data, start, stop):
+        rate = self.server.connection_rate
+        block = 64 * 1024
+        began = time.time()
+        sent = 0
+        for offset in range(start, stop, block):
+            chunk = data[offset:min(offset + block, stop)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if rate:
+                delay = began + float(sent) / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the support portal and the download server
+
+    pages maps the listing paths to their HTML. Links to the real download
+    server in them are rewritten to point at the stand-in.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data="", connection_rate=0, ranges=True, pages=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.data = data
+        self.connection_rate = connection_rate
+        self.ranges = ranges
+        self.logins = 0
+        self.pages = {}
+        for path, page in (pages or {}).items():
+            self.pages[path] = page.replace(PORTAL_DOWNLOAD_URL, self.url)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def patch(self, downloader_class):
+        """Point the portal URLs of downloader_class at the stand-in"""
+        downloader_class.SUPPORT_URL = self.url
+        downloader_class.DOWNLOAD_URL = self.url
+        downloader_class.UPDATE_URL = self.url + "Updates/DynamicUpdates"
+        downloader_class.SOFTWARE_URL = self.url + "Updates/SoftwareUpdates/"
+
+
+def synthetic_updates(digest=None):
+    """DynamicUpdates page listing 20 versions of every content package
+
+    The files are listed with the SHA-256 digest, if given, or with
+    random ones.
+    """
+    rows = []
+    for package, path in sorted(ContentDownloader.PACKAGE.items()):
+        for number in range(20):
+            version = "%d-%d" % (600 - number, 3000 - number * 4)
+            rows.append('<tr><td>%s</td><td><a href="%s%s-%s?__gda__=%d_benchmark">Download</a></td><td>%s</td></tr>'
+                        % (package, PORTAL_DOWNLOAD_URL, path, version, number,
+                           digest or "%064x" % random.getrandbits(256)))
+    return "<html><body><table>\n%s\n</table></body></html>" % "\n".join(rows)
+
+
+# Filenames on the generated SoftwareUpdates page, including ones
+# generate_release_list() skips
+RELEASE_PATTERNS = [
+    "PanOS_%(model)s-%(version)s",
+    "PA-VM-%(platform)s-%(version)s.ova",
+    "Panorama_pc-%(version)s",
+    "PanGP-%(version)s",
+    "Traps_x64_%(version)s.msi",
+    "UaInstall-%(version)s.msi",
+    "WFWin7-%(version)s.pkg",
+    "GlobalProtect-%(version)s.apk",
+]
+
+
+class MockApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the PAN-OS XML API import, install and show jobs calls"""
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        command = query.get("cmd", [""])[0]
+        if self._denied(query) or query.get("type") != ["op"]:
+            return
+        match = re.search(r"<id>(\d+)</id>", command)
+        if "<install>" in command:
+            job = self.server.start_job()
+            return self._send("<result><msg>Install job enqueued</msg><job>%d</job></result>" % job)
+        if match is not None:
+            finished = self.server.job_finished(int(match.group(1)))
+            return self._send("<result><job><id>%s</id><status>%s</status><result>%s</result>"
+                              "<details><line>Configuration committed successfully</line></details></job></result>"
+                              % (match.group(1), "FIN" if finished else "ACT", "OK" if finished else "PEND"))
+        self._send("<msg>Unknown command</msg>", "error")
+
+    def do_POST(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        remaining = int(self.headers.get("Content-Length") or 0)
+        # The upload is read and thrown away, like a firewall storing it
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        if self._denied(query):
+            return
+        if query.get("type") != ["import"]:
+            return self._send("<msg>Unknown request</msg>", "error")
+        self.server.imports += 1
+        self._send("<msg>File successfully uploaded</msg>")
+
+    def _denied(self, query):
+        if self.headers.get("X-PAN-KEY") == self.server.key or query.get("key") == [self.server.key]:
+            return False
+        self._send("<msg>Invalid credentials.</msg>", "error", 403)
+        return True
+
+    def _send(self, body, status="success", code=200):
+        body = '<response status="%s">%s</response>' % (status, body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the XML API of a firewall or Panorama
+
+    Install jobs finish install_seconds after they are started.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, key="benchmark", install_seconds=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), MockApiHandler)
+        self.key = key
+        self.install_seconds = install_seconds
+        self.imports = 0
+        self.jobs = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def start_job(self):
+        with self._lock:
+            self.jobs.append(time.time() + self.install_seconds)
+            return len(self.jobs)
+
+    def job_finished(self, job):
+        return time.time() >= self.jobs[job - 1]
+
+
+def synthetic_releases(count):
+    """SoftwareUpdates page with count download links, and some release notes"""
+    rows = []
+    for number in range(count):
+        version = "%d.%d.%d" % (random.randint(5, 10), random.randint(0, 1), random.randint(0, 20))
+        if random.random() < 0.2:
+            version += "-h%d" % random.randint(1, 9)
+        filename = random.choice(RELEASE_PATTERNS) % {
+            "model": random.choice(["200", "500", "3000", "5000", "7000", "vm"]),
+            "platform": random.choice(["ESX", "KVM", "NSX", "HPV"]),
+            "version": version,
+        }
+        rows.append('<tr><td><a href="%ssoftware/%s?__gda__=%d_benchmark">%s</a></td><td>%064x</td></tr>'
+                    % (PORTAL_DOWNLOAD_URL, filename, number, filename, random.getrandbits(256)))
+        if number % 100 == 0:
+            rows.append('<tr><td><a href="%ssoftware/notes-%s.pdf">Release notes %s.pdf</a></td></tr>'
+                        % (PORTAL_DOWNLOAD_URL, version, version))
+    return "<html><body><table>\n%s\n</table></body></html>" % "\n".join(rows)
+
+
+def listing_pages(options):
+    """Listing pages to serve, from the fixtures directory if given"""
+    if options.fixtures is None:
+        return {
+            "/Updates/DynamicUpdates": synthetic_updates(),
+            "/Updates/SoftwareUpdates/": synthetic_releases(options.links),
+        }
+    pages = {}
+    for path, filename in FIXTURES.items():
+        with open(os.path.join(options.fixtures, filename)) as f:
+            pages[path] = f.read()
+    return pages
+
+
+def record_fixtures(directory):
+    """Save the listing pages of the real portal as fixtures"""
+    username, password, download_dir = get_config(load_config('content_downloader.conf'))
+    downloader = ContentDownloader(username=username, password=password)
+    downloader.ensure_login()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for url in (downloader.UPDATE_URL, downloader.SOFTWARE_URL):
+        filename = FIXTURES["/" + url.split("/", 3)[3]]
+        page = downloader._open_listing(url).read()
+        with open(os.path.join(directory, filename), "w") as f:
+            f.write(page)
+        print("Recorded %s (%d bytes)" % (filename, len(page)))
+
+
+def load_software_downloader():
+    """software-downloader.py imported as a module"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "software-downloader.py")
+    return imp.load_source("software_downloader", path)
+
+
+def report(name, timings, extra=""):
+    timings = sorted(timings)
+    print("%-28s median %9.2fms  min %9.2fms%s"
+          % (name, timings[len(timings) // 2] * 1000, timings[0] * 1000, extra))
+
+
+def benchmark_check(options):
+    server = StandInServer(pages=listing_pages(options)).start()
+    server.patch(ContentDownloader)
+    workdir = tempfile.mkdtemp()
+    login, logged_in, not_modified = [], [], []
+    try:
+        for repeat in range(options.repeat):
+            downloader = ContentDownloader("benchmark", "benchmark", backend=options.backend,
+                                           cookiefile=os.path.join(workdir, "cookies%d.txt" % repeat),
+                                           cache=PageCache(os.path.join(workdir, "cache%d.json" % repeat)))
+            began = time.time()
+            downloader.check()
+            login.append(time.time() - began)
+            began = time.time()
+            downloader.check(use_cache=False)
+            logged_in.append(time.time() - began)
+            began = time.time()
+            downloader.check()
+            not_modified.append(time.time() - began)
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+    report("Check with login", login)
+    report("Check, logged in", logged_in)
+    report("Check, listing not modified", not_modified)
+
+
+def benchmark_parse(options):
+    software_downloader = load_software_downloader()
+    page = listing_pages(options)["/Updates/SoftwareUpdates/"]
+    workdir = tempfile.mkdtemp()
+    try:
+        downloader = ContentDownloader("", "", cookiefile=os.path.join(workdir, "cookies.txt"))
+        downloader.DOWNLOAD_URL = PORTAL_DOWNLOAD_URL
+        scan, generate, latest = [], [], []
+        for repeat in range(options.repeat):
+            began = time.time()
+            releases = list(downloader._parse_releases(LinkScanner().scan(StringIO.StringIO(page))))
+            scan.append(time.time() - began)
+            unparsed = []
+            began = time.time()
+            release_list = software_downloader.generate_release_list(releases, unparsed)
+            generate.append(time.time() - began)
+            began = time.time()
+            trains = software_downloader.latest_in_trains(release_list)
+            latest.append(time.time() - began)
+    finally:
+        shutil.rmtree(workdir)
+    print("Listing of %d KB with %d download links: %d releases in %d trains, %d unparsed"
+          % (len(page) // 1024, len(releases), len(release_list), len(trains), len(unparsed)))
+    report("Scan links", scan, "  %9d links/s" % (len(releases) / sorted(scan)[len(scan) // 2]))
+    report("generate_release_list()", generate,
+           "  %9d links/s" % (len(releases) / sorted(generate)[len(generate) // 2]))
+    report("latest_in_trains()", latest)
+
+
+# Runs content_downloader.py against the stand-in at url
+STARTUP_SCRIPT = """import sys
+sys.path.insert(0, %(path)r)
+sys.argv = %(argv)r
+import content_downloader
+downloader = content_downloader.ContentDownloader
+downloader.SUPPORT_URL = downloader.DOWNLOAD_URL = %(url)r
+downloader.UPDATE_URL = %(url)r + "Updates/DynamicUpdates"
+content_downloader.main()
+"""
+
+STARTUP_CONFIG = """[config]
+username=benchmark
+password=benchmark
+filedir=%(directory)s
+cache_ttl=%(ttl)d
+"""
+
+
+def time_run(argv, url, workdir, ttl):
+    """Wall time of a content_downloader.py run with argv, in a new interpreter"""
+    with open(os.path.join(workdir, "content_downloader.conf"), "w") as f:
+        f.write(STARTUP_CONFIG % {"directory": workdir, "ttl": ttl})
+    script = STARTUP_SCRIPT % {"path": os.path.dirname(os.path.abspath(__file__)), "argv": argv, "url": url}
+    began = time.time()
+    with open(os.devnull, "w") as devnull:
+        code = subprocess.call([sys.executable, "-c", script], cwd=workdir, stdout=devnull)
+    elapsed = time.time() - began
+    if code not in (0, 1):
+        raise RuntimeError("content_downloader.py %s exited with %d" % (" ".join(argv[1:]), code))
+    return elapsed
+
+
+def benchmark_startup(options):
+    server = StandInServer(pages=listing_pages(options)).start()
+    workdir = tempfile.mkdtemp()
+    runs = [
+        ("Interpreter only", None, 0),
+        ("Run, listing not modified", ["content_downloader.py"], 0),
+        ("--check, listing not modified", ["content_downloader.py", "--check"], 0),
+        ("Run, listing cached", ["content_downloader.py"], 3600),
+        ("--check, listing cached", ["content_downloader.py", "--check"], 3600),
+    ]
+    timings = dict((name, []) for name, argv, ttl in runs)
+    try:
+        # Log in and fill the listing cache, and have the latest version
+        time_run(["content_downloader.py", "--check"], server.url, workdir, 0)
+        latest = re.search(r"panupv2-all-contents-[0-9-]+(?=\?)", server.pages["/Updates/DynamicUpdates"])
+        open(os.path.join(workdir, latest.group(0)), "w").close()
+        for repeat in range(options.repeat):
+            for name, argv, ttl in runs:
+                if argv is None:
+                    began = time.time()
+                    subprocess.call([sys.executable, "-c", "pass"])
+                    timings[name].append(time.time() - began)
+                else:
+                    timings[name].append(time_run(argv, server.url, workdir, ttl))
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+    for name, argv, ttl in runs:
+        report(name, timings[name])
+
+
+def time_push(options, server, targets, pipelined):
+    """Seconds from starting the downloads until every package is installed on every target"""
+    workdir = tempfile.mkdtemp()
+    pipeline = PushPipeline([PushTarget("target%d" % number, target.url, target.key, concurrency=options.concurrency)
+                             for number, target in enumerate(targets)], options.push_workers if pipelined else 1)
+    pipeline.JOB_POLL_INTERVAL = 0.05
+    try:
+        downloader = ContentDownloader("benchmark", "benchmark", backend=options.backend,
+                                       cookiefile=os.path.join(workdir, "cookies.txt"))
+        began = time.time()
+        updates = downloader.check_packages(sorted(ContentDownloader.PACKAGE))
+        jobs = [(url, ContentDownloader.get_prefix(package) + "-" + version)
+                for package, (version, url) in updates.items()]
+        ContentDownloader.pipeline = pipeline if pipelined else None
+        downloaded = downloader.download_files(workdir, jobs)
+        if not pipelined:
+            # One push at a time, once all downloads are done
+            for filename in downloaded:
+                pipeline.submit(os.path.join(workdir, filename))
+        results = pipeline.wait()
+        elapsed = time.time() - began
+    finally:
+        ContentDownloader.pipeline = None
+        shutil.rmtree(workdir)
+    failed = [result for result in results if result.status != "installed"]
+    if failed or len(results) != len(jobs) * len(targets):
+        raise RuntimeError("%d of %d pushes failed" % (len(failed), len(jobs) * len(targets)))
+    return elapsed
+
+
+def benchmark_push(options):
+    data = os.urandom(options.size * 1024 * 1024)
+    pages = {
+        "/Updates/DynamicUpdates": synthetic_updates(hashlib.sha256(data).hexdigest()),
+        "/Updates/SoftwareUpdates/": synthetic_releases(10),
+    }
+    server = StandInServer(data, options.connection_rate * 1024 * 1024, pages=pages).start()
+    server.patch(ContentDownloader)
+    targets = [MockApiServer(install_seconds=options.install_seconds).start() for _ in range(options.targets)]
+    try:
+        sequential = time_push(options, server, targets, False)
+        pipelined = time_push(options, server, targets, True)
+    finally:
+        for target in targets:
+            target.shutdown()
+        server.shutdown()
+    print("%d packages of %d MB to %d targets, installs taking %.1fs"
+          % (len(ContentDownloader.PACKAGE), options.size, options.targets, options.install_seconds))
+    print("Download, then push one at a time: %6.2fs" % sequential)
+    print("Pipelined, concurrent pushes:      %6.2fs" % pipelined)
+
+
+def time_download(function, url, filename):
+    began = time.time()
+    function(url, filename)
+    elapsed = time.time() - began
+    os.remove(filename)
+    return elapsed
+
+
+def benchmark_download(options):
+    data = os.urandom(options.size * 1024 * 1024)
+    server = StandInServer(data, options.connection_rate * 1024 * 1024, not options.no_range).start()
+    url = server.url + "software/PanOS_7000-8.0.1?__gda__=benchmark"
+    workdir = tempfile.mkdtemp()
+    try:
+        downloader = ContentDownloader("", "", backend=options.backend,
+                                       cookiefile=os.path.join(workdir, "cookies.txt"))
+        filename = os.path.join(workdir, "PanOS_7000-8.0.1")
+        single = time_download(downloader.retrieve, url, filename)
+        segmented = time_download(lambda u, f: downloader.retrieve_segmented(u, f, options.segments), url, filename)
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+    size = float(len(data)) / (1024 * 1024)
+    print("File size:          %d MB" % options.size)
+    print("Single stream:      %6.2fs %8.2f MB/s" % (single, size / single))
+    print("%2d segments:        %6.2fs %8.2f MB/s" % (options.segments, segmented, size / segmented))
+
+
+BENCHMARKS = {
+    "check": benchmark_check,
+    "parse": benchmark_parse,
+    "download": benchmark_download,
+    "startup": benchmark_startup,
+    "push": benchmark_push,
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the downloaders against a local portal stand-in')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help="Benchmarks to run: check, parse, download, startup or push (default all)")
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help="Size of the test file in MB, or of each package in the push benchmark (default 64)")
+    parser.add_argument('-n', '--segments', type=int, default=ContentDownloader.DOWNLOAD_SEGMENTS,
+                        help="Number of segments for the segmented download (default %d)"
+                             % ContentDownloader.DOWNLOAD_SEGMENTS)
+    parser.add_argument('-r', '--connection-rate', type=float, default=8,
+                        help="Throughput limit of each connection in MB/s, 0 for unlimited (default 8)")
+    parser.add_argument('--no-range', action='store_true', help="Make the stand-in ignore Range requests")
+    parser.add_argument('-b', '--backend', choices=ContentDownloader.BACKENDS, default="mechanize",
+                        help="HTTP client backend (default mechanize)")
+    parser.add_argument('-l', '--links', type=int, default=50000,
+                        help="Number of download links on the generated SoftwareUpdates page (default 50000)")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs of the check, parse and startup benchmarks (default 5)")
+    parser.add_argument('-t', '--targets', type=int, default=8,
+                        help="Number of mock XML API targets in the push benchmark (default 8)")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="Concurrent pushes to each target in the push benchmark (default 1)")
+    parser.add_argument('--push-workers', type=int, default=8,
+                        help="Concurrent pushes in all in the push benchmark (default 8)")
+    parser.add_argument('--install-seconds', type=float, default=1,
+                        help="Time the mock targets take to install a package (default 1)")
+    parser.add_argument('--fixtures', help="Directory of recorded listing pages to serve instead of generated ones")
+    parser.add_argument('--record', metavar='DIRECTORY',
+                        help="Record the listing pages of the real portal to DIRECTORY, using the credentials "
+                             "in content_downloader.conf, and exit")
+    options = parser.parse_args()
+    for benchmark in options.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("Unknown benchmark: %s" % benchmark)
+    return options
+
+
+def main():
+    options = parse_arguments()
+    if options.record:
+        record_fixtures(options.record)
+        return
+    # Segment files of any size so small test files are split as well
+    ContentDownloader.SEGMENT_MIN_SIZE = 0
+    for benchmark in options.benchmarks or ["check", "parse", "download", "startup", "push"]:
+        print("== %s" % benchmark)
+        BENCHMARKS[benchmark](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -36,12 +36,40 @@ from __future__ import print_function
 import os
 import sys
 import re
-import cookielib
 import logging
 import ConfigParser
 import argparse
+import threading
+import Queue
+import json
+import codecs
+import HTMLParser
+import time
+import random
+import hashlib
+import atexit
+import tempfile
+from contextlib import contextmanager
 
-import mechanize
+import urllib
+import urllib2
+import urlparse
+import httplib
+import socket
+import StringIO
+import ssl
+import collections
+import BaseHTTPServer
+import SocketServer
+
+# Imported by import_mechanize() once a mechanize browser is needed, as
+# the import takes longer than a check answered from the listing cache
+mechanize = None
+try:
+    import fcntl
+except ImportError:
+    # No file locking on this platform
+    fcntl = None
 # Disable insecure platform warnings
 #import requests.packages.urllib3
 #requests.packages.urllib3.disable_warnings()
@@ -55,6 +83,1344 @@ class UpdateError(StandardError):
 class UnknownPackage(StandardError):
     pass
 
+class ChecksumError(StandardError):
+    pass
+
+
+class PushError(StandardError):
+    pass
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of a request while the RetryPolicy circuit is open"""
+    pass
+
+
+# Failures of requests to the portal, after any retries, that a run can carry on after
+REQUEST_ERRORS = (IOError, httplib.HTTPException, UpdateError, LoginError)
+
+
+def import_mechanize():
+    """The mechanize module, imported on first use"""
+    global mechanize
+    if mechanize is None:
+        try:
+            import mechanize as module
+        except ImportError:
+            # Only the pooled backend can be used
+            raise ImportError("mechanize is required for the mechanize backend")
+        mechanize = module
+    return mechanize
+
+
+def account_filename(filename, username):
+    """filename of another support account, eg. cookies-jane@example.com.txt"""
+    root, ext = os.path.splitext(filename)
+    return "%s-%s%s" % (root, re.sub(r"[^\w.@-]", "_", username), ext)
+
+
+def run_threads(target, count):
+    """Run target in count threads and wait for all of them to finish"""
+    threads = [threading.Thread(target=target) for _ in range(max(1, count))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class TokenBucket(object):
+    """Token bucket limiting the combined throughput of transfers
+
+    rate is in bytes per second and burst the number of bytes that may be
+    read at once after an idle period. Transfers have a priority: while a
+    transfer of higher priority is active, transfers of lower priority
+    wait, so a small content package is never stuck behind a large
+    software image.
+
+    The tokens and the active transfers of every process are kept in the
+    JSON file filename, under a FileLock, so content_downloader.py and
+    software-downloader.py runs share one limit and see each other's
+    priorities. The transfers of a process that hasn't used the bucket
+    for STALE seconds, for instance because it was killed, no longer
+    count. Without fcntl the processes aren't kept apart while updating
+    the file, and the limit only holds approximately between them.
+    """
+
+    FILENAME = "pan_downloader_rate.json"
+    # Seconds between checks while a transfer of higher priority is active
+    POLL_INTERVAL = 0.5
+    STALE = 60
+
+    def __init__(self, rate, burst=None, filename=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        # Smaller reads keep the shaped traffic smooth
+        self.chunk_size = int(max(16 * 1024, min(ContentDownloader.CHUNK_SIZE, self.rate / 8)))
+        if filename is None:
+            filename = os.path.join(tempfile.gettempdir(), self.FILENAME)
+        self.filename = filename
+        self.lock = FileLock(filename + ".lock")
+        # Active transfers of this process, by priority
+        self._active = {}
+
+    @contextmanager
+    def transfer(self, priority):
+        """Register an active transfer of the given priority"""
+        with self.lock:
+            self._active[priority] = self._active.get(priority, 0) + 1
+            self._save(self._load())
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._active[priority] -= 1
+                self._save(self._load())
+
+    def consume(self, amount, priority=0):
+        """Wait until amount bytes may be read"""
+        while True:
+            with self.lock:
+                state = self._load()
+                now = time.time()
+                if self._outranked(state, priority, now):
+                    delay = self.POLL_INTERVAL
+                else:
+                    state["tokens"] = min(self.burst, state["tokens"] + (now - state["updated"]) * self.rate)
+                    state["updated"] = now
+                    if state["tokens"] >= min(amount, self.burst):
+                        state["tokens"] -= amount
+                        self._save(state)
+                        return
+                    delay = (min(amount, self.burst) - state["tokens"]) / self.rate
+                self._save(state)
+            time.sleep(delay)
+
+    def _outranked(self, state, priority, now):
+        """Whether a transfer of higher priority is active in any process"""
+        for pid, entry in state["transfers"].items():
+            if pid != str(os.getpid()) and now - entry["seen"] > self.STALE:
+                continue
+            if any(count for p, count in entry["active"].items() if int(p) > priority):
+                return True
+        return False
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"tokens": self.burst, "updated": time.time(), "transfers": {}}
+
+    def _save(self, state):
+        """Write state with the active transfers of this process, dropping those of stale ones"""
+        now = time.time()
+        transfers = dict((pid, entry) for pid, entry in state["transfers"].items()
+                         if now - entry["seen"] <= self.STALE)
+        active = dict((str(p), count) for p, count in self._active.items() if count)
+        if active:
+            transfers[str(os.getpid())] = {"active": active, "seen": now}
+        else:
+            transfers.pop(str(os.getpid()), None)
+        state["transfers"] = transfers
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.rename(self.filename + ".tmp", self.filename)
+
+
+def parse_size(size):
+    """Parse a size like '500K' or '2M' into bytes"""
+    size = size.strip().upper()
+    multiplier = 1
+    if size[-1:] in ("K", "M", "G"):
+        multiplier = 1024 ** ("KMG".index(size[-1]) + 1)
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+
+class Metrics(object):
+    """Timings and counters of the phases of a run
+
+    Each timed phase and event is written as a JSON object on its own line
+    to the events file ('-' for stderr), if any, with the event name, the
+    time and the fields of the event. Phase timings and counters are also
+    totalled, and write_prometheus() writes the totals to a Prometheus
+    textfile, for the node_exporter textfile collector.
+    """
+
+    PREFIX = "content_downloader"
+
+    def __init__(self, events=None, prometheus=None):
+        self.events = events
+        self.prometheus = prometheus
+        self.counters = {}
+        # Number of runs and total seconds of each phase
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def event(self, name, **fields):
+        if self.events is None:
+            return
+        record = {"event": name, "time": round(time.time(), 3)}
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            if self._file is None:
+                self._file = sys.stderr if self.events == "-" else open(self.events, "a")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, phase, **fields):
+        """Time a phase. Yields the dict of event fields, to add to it"""
+        began = time.time()
+        status = "error"
+        try:
+            yield fields
+            status = "ok"
+        finally:
+            elapsed = time.time() - began
+            with self._lock:
+                timing = self.timings.setdefault(phase, [0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+            self.event(phase, seconds=round(elapsed, 6), status=status, **fields)
+
+    def write_prometheus(self):
+        """Write the totals to the Prometheus textfile, if any"""
+        if self.prometheus is None:
+            return
+        lines = []
+        with self._lock:
+            timings = sorted(self.timings.items())
+            lines.append("# TYPE %s_phase_seconds_total counter" % self.PREFIX)
+            for phase, (runs, seconds) in timings:
+                lines.append('%s_phase_seconds_total{phase="%s"} %f' % (self.PREFIX, phase, seconds))
+            lines.append("# TYPE %s_phase_runs_total counter" % self.PREFIX)
+            for phase, (runs, seconds) in timings:
+                lines.append('%s_phase_runs_total{phase="%s"} %d' % (self.PREFIX, phase, runs))
+            for name, value in sorted(self.counters.items()):
+                lines.append("# TYPE %s_%s_total counter" % (self.PREFIX, name))
+                lines.append("%s_%s_total %s" % (self.PREFIX, name, value))
+        lines.append("# TYPE %s_last_update_timestamp_seconds gauge" % self.PREFIX)
+        lines.append("%s_last_update_timestamp_seconds %d" % (self.PREFIX, time.time()))
+        with open(self.prometheus + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(self.prometheus + ".tmp", self.prometheus)
+
+
+class RetryPolicy(object):
+    """Retries of transient request failures, shared by every request of a run
+
+    A request that fails with a network error, a 5xx or 429 response, or
+    an incomplete page is retried after an exponential backoff with
+    random jitter, at most RETRIES[phase] times. Every phase (login,
+    listing, download) also has a retry budget: its retries may add up to
+    at most RETRY_RATIO of its requests plus RETRY_MINIMUM, so retries
+    can't multiply the load on a struggling portal.
+
+    After FAILURE_THRESHOLD failures in a row the circuit opens, and
+    requests fail right away with CircuitOpenError for COOLDOWN seconds.
+    The first request after that probes the portal, and a single failure
+    opens the circuit again until a request succeeds. Failures, retries
+    and circuit openings are counted in the Metrics given to call().
+    """
+
+    RETRIES = {"login": 2, "listing": 3, "download": 5}
+    BASE_DELAY = 1.0
+    MAX_DELAY = 60
+    RETRY_RATIO = 0.2
+    RETRY_MINIMUM = 10
+    # Above every RETRIES, so the retries of a single request can't open
+    # the circuit on their own
+    FAILURE_THRESHOLD = 8
+    COOLDOWN = 60
+
+    def __init__(self):
+        # Requests, failures and retries of each phase
+        self.requests = {}
+        self.failures = {}
+        self.retries = {}
+        # Failures in a row, of any phase, and until when the circuit is open
+        self.consecutive = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def call(self, phase, what, metrics, function, *args):
+        """function(*args), retried on transient failures
+
+        what describes the request in log messages. Errors that a nested
+        call() already gave up on are passed on without further retries.
+        """
+        retry = 0
+        while True:
+            self._before(phase, what, metrics)
+            try:
+                result = function(*args)
+            except (IOError, httplib.HTTPException, UpdateError) as e:
+                if getattr(e, "retried", False) or not self.transient(e):
+                    raise
+                retry += 1
+                delay = self._failed(phase, retry, metrics)
+                if delay is None:
+                    e.retried = True
+                    raise
+                logging.warning("%s failed (%s), retrying in %.1f seconds (retry %d of %d)"
+                                % (what, e, delay, retry, self.RETRIES[phase]))
+                time.sleep(delay)
+            else:
+                with self._lock:
+                    self.consecutive = 0
+                return result
+
+    @staticmethod
+    def transient(error):
+        """Whether a request that failed with error may succeed when retried"""
+        if isinstance(error, urllib2.HTTPError):
+            return error.code >= 500 or error.code == 429
+        if isinstance(error, urllib2.URLError):
+            return isinstance(error.reason, socket.error)
+        # Other IOErrors are local, like a full disk, and would fail again
+        return isinstance(error, (socket.error, httplib.HTTPException, UpdateError))
+
+    def _before(self, phase, what, metrics):
+        with self._lock:
+            if time.time() < self.open_until:
+                metrics.count("circuit_rejections")
+                raise CircuitOpenError("%s not attempted, the portal failed %d times in a row"
+                                       % (what, self.consecutive))
+            self.requests[phase] = self.requests.get(phase, 0) + 1
+
+    def _failed(self, phase, retry, metrics):
+        """Record a failure. Returns the delay before the retry-th retry, or None to give up"""
+        metrics.count("%s_request_failures" % phase)
+        with self._lock:
+            self.failures[phase] = self.failures.get(phase, 0) + 1
+            self.consecutive += 1
+            if self.consecutive >= self.FAILURE_THRESHOLD:
+                self.open_until = time.time() + self.COOLDOWN
+                metrics.count("circuit_opened")
+                logging.warning("Requests failed %d times in a row, pausing requests for %d seconds"
+                                % (self.consecutive, self.COOLDOWN))
+                return None
+            retries = self.retries.get(phase, 0)
+            if retry > self.RETRIES[phase] or retries >= self.RETRY_MINIMUM + self.RETRY_RATIO * self.requests[phase]:
+                return None
+            self.retries[phase] = retries + 1
+        metrics.count("%s_retries" % phase)
+        backoff = min(self.MAX_DELAY, self.BASE_DELAY * 2 ** (retry - 1))
+        return random.uniform(backoff / 2, backoff)
+
+
+class StreamDigest(object):
+    """SHA-256 of a file, computed while the file is being written
+
+    An MD5 digest is computed as well when a published MD5 checksum has
+    to be checked.
+    """
+
+    def __init__(self, md5=False):
+        self.md5 = md5
+        self.reset()
+
+    def reset(self):
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5() if self.md5 else None
+
+    def update(self, data):
+        self.size += len(data)
+        self._sha256.update(data)
+        if self._md5 is not None:
+            self._md5.update(data)
+
+    def catch_up(self, filename, size):
+        """Hash bytes of filename already on disk up to size
+
+        Needed when resuming a part file left behind by an earlier run, and
+        for data that download segments wrote ahead of the hashed part.
+        """
+        if self.size > size:
+            self.reset()
+        if self.size == size:
+            return
+        with open(filename, "rb") as f:
+            f.seek(self.size)
+            while self.size < size:
+                data = f.read(min(ContentDownloader.CHUNK_SIZE, size - self.size))
+                if not data:
+                    raise IOError("%s is shorter than %d bytes" % (filename, size))
+                self.update(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def matches(self, checksum):
+        """True if checksum (SHA-256 or MD5, in hex) matches the data"""
+        checksum = checksum.lower()
+        if len(checksum) == 32:
+            return self._md5 is not None and self._md5.hexdigest() == checksum
+        return self._sha256.hexdigest() == checksum
+
+
+def write_checksum(filename, hexdigest):
+    """Record the SHA-256 of filename in a sha256sum style sidecar file"""
+    with open(filename + ".sha256", "w") as f:
+        f.write("%s  %s\n" % (hexdigest, os.path.basename(filename)))
+
+
+def read_checksum(filename):
+    """SHA-256 of filename from its sidecar file, or None if there is none"""
+    try:
+        with open(filename + ".sha256") as f:
+            return f.read().split()[0]
+    except (IOError, IndexError):
+        return None
+
+
+def verify_directory(download_dir, workers=4):
+    """Check every file in download_dir against its sidecar checksum
+
+    Files are hashed concurrently. Returns the names of the files that are
+    missing or don't match their checksum.
+    """
+    queue = Queue.Queue()
+    for f in sorted(os.listdir(download_dir)):
+        if f.endswith(".sha256"):
+            queue.put(f[:-len(".sha256")])
+    logging.info("Verifying %d files in %s" % (queue.qsize(), download_dir))
+    failed = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                filename = queue.get_nowait()
+            except Queue.Empty:
+                return
+            path = os.path.join(download_dir, filename)
+            digest = StreamDigest()
+            try:
+                digest.catch_up(path, os.path.getsize(path))
+            except (IOError, OSError) as e:
+                logging.error("Unable to verify %s: %s" % (filename, e))
+                with lock:
+                    failed.append(filename)
+                continue
+            if not digest.matches(read_checksum(path) or ""):
+                logging.error("Checksum mismatch: %s" % filename)
+                with lock:
+                    failed.append(filename)
+            else:
+                logging.info("Verified: %s" % filename)
+
+    run_threads(worker, min(workers, queue.qsize()))
+    return sorted(failed)
+
+
+class FileLock(object):
+    """Exclusive lock on a lock file, shared by threads and processes
+
+    Can be entered again by the thread holding it. Without fcntl only the
+    threads of this process are kept apart.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._lockfile = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._lockfile = open(self.filename, "a")
+                fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+            except:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0 and self._lockfile is not None:
+            fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+            self._lockfile.close()
+            self._lockfile = None
+        self._lock.release()
+
+
+class SessionManager(object):
+    """Keeps the support portal login cookies and their expiry on disk
+
+    The cookie jar is stored in cookiefile and the time the login expires in
+    cookiefile + '.session'. Both are read and written while holding an
+    exclusive lock on cookiefile + '.lock', so concurrent runs share a single
+    login instead of overwriting each other's cookies.
+    """
+
+    # Lifetime assumed for a login when none of its cookies has an expiry
+    SESSION_LIFETIME = 3600
+    # Log in again this many seconds before the login expires
+    REFRESH_MARGIN = 300
+
+    def __init__(self, cookiejar, cookiefile="cookies.txt"):
+        self.cj = cookiejar
+        self.cookiefile = cookiefile
+        self.expires = None
+        self._rejected = None
+        self.lock = FileLock(cookiefile + ".lock")
+
+    def load(self):
+        with self.lock:
+            try:
+                self.cj.load(self.cookiefile, ignore_discard=True, ignore_expires=True)
+            except IOError:
+                # Ignore if there are no cookies to load
+                logging.debug("No existing cookies found")
+            try:
+                with open(self.cookiefile + ".session") as f:
+                    self.expires = json.load(f)["expires"]
+            except (IOError, ValueError, KeyError):
+                self.expires = None
+            if self.expires is not None and self.expires == self._rejected:
+                # The portal already turned this login down
+                self.expires = None
+
+    def save(self):
+        with self.lock:
+            self.cj.save(self.cookiefile, ignore_discard=True, ignore_expires=True)
+            with open(self.cookiefile + ".session", "w") as f:
+                json.dump({"expires": self.expires}, f)
+
+    def is_valid(self):
+        """True if the login is not about to expire"""
+        return self.expires is not None and time.time() < self.expires - self.REFRESH_MARGIN
+
+    def logged_in(self):
+        """Record a new login, expiring with the first of its cookies"""
+        now = time.time()
+        expiry = [c.expires for c in self.cj if c.expires is not None and c.expires > now]
+        self.expires = min(expiry + [now + self.SESSION_LIFETIME])
+        logging.debug("Login expires in %d seconds" % (self.expires - now))
+
+    def invalidate(self):
+        """Forget a login the portal no longer accepts"""
+        self._rejected = self.expires
+        self.expires = None
+
+
+def version_key(version):
+    """Sort key for a version: the numbers in it, eg. 578-2874 after 577-2870 and 8.0.10 after 8.0.9"""
+    return tuple(int(number) for number in re.findall(r"[0-9]+", version))
+
+
+def parse_package_filename(filename):
+    """(prefix, version) of a content package filename, or (None, None)"""
+    for path in ContentDownloader.PACKAGE.values():
+        prefix = path.split("/")[-1]
+        match = re.match(re.escape(prefix) + r"-([\d-]*)$", filename)
+        if match is not None:
+            return prefix, match.group(1)
+    return None, None
+
+
+class RepositoryIndex(object):
+    """Index of the files downloaded to a directory
+
+    Kept as JSON in FILENAME inside the directory. For every file it
+    records the package and version, size, SHA-256 and download time.
+    Content packages are indexed by their filename prefix and version,
+    other downloads by the package 'software' and their filename. Every
+    change is written atomically while holding a lock on the index, so
+    concurrent downloaders don't lose each other's entries.
+
+    Files added or removed by hand are picked up by reconcile(), which
+    only rescans the directory when its mtime changed since the last scan.
+    """
+
+    FILENAME = ".content_index.json"
+    # Files of the downloaders themselves, never indexed
+    IGNORED_SUFFIXES = (".part", ".segments", ".sha256", ".tmp", ".lock")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = os.path.join(directory, self.FILENAME)
+        self.lock = FileLock(self.filename + ".lock")
+        self.files = {}
+        # Directory mtime at the last scan by reconcile()
+        self.mtime = None
+        self._versions = {}
+        with self.lock:
+            self._load()
+
+    def has(self, package, version):
+        return (package, version) in self._versions
+
+    def versions(self, package):
+        return [version for p, version in self._versions if p == package]
+
+    def add(self, filename, package=None, version=None, digest=None):
+        """Add a file that has just been downloaded to the directory"""
+        if package is None:
+            package, version = parse_package_filename(filename)
+            if package is None:
+                package, version = "software", filename
+        with self.lock:
+            self._load()
+            self._add(filename, package, version, digest, time.time())
+            self._save()
+
+    def remove(self, filename):
+        with self.lock:
+            self._load()
+            self.files.pop(filename, None)
+            self._save()
+
+    def reconcile(self, force=False):
+        """Rescan the directory if it changed since it was last scanned
+
+        Files that are gone are dropped. New content packages, and other
+        files with a checksum sidecar, are added. The index is only written
+        if that changed it. Returns True if the directory was rescanned.
+        """
+        # Taken before the scan, so a change during the scan is noticed next time
+        mtime = os.stat(self.directory).st_mtime
+        if not force and mtime == self.mtime:
+            return False
+        with self.lock:
+            self._load()
+            names = set(os.listdir(self.directory))
+            changed = False
+            for filename in list(self.files):
+                if filename not in names:
+                    logging.debug("Removing %s from index" % filename)
+                    del self.files[filename]
+                    changed = True
+            for filename in names:
+                if filename in self.files or filename == self.FILENAME or filename.endswith(self.IGNORED_SUFFIXES):
+                    continue
+                path = os.path.join(self.directory, filename)
+                package, version = parse_package_filename(filename)
+                if package is None:
+                    if not os.path.exists(path + ".sha256"):
+                        continue
+                    package, version = "software", filename
+                logging.debug("Adding %s to index" % filename)
+                self._add(filename, package, version, read_checksum(path), os.path.getmtime(path))
+                changed = True
+            if changed:
+                self._save()
+        # A change within the same clock tick may leave the mtime as it was,
+        # so a directory changed just before the scan is scanned again
+        self.mtime = mtime if time.time() - mtime > 1 else None
+        return True
+
+    def _add(self, filename, package, version, digest, downloaded):
+        self.files[filename] = {
+            "package": package,
+            "version": version,
+            "size": os.path.getsize(os.path.join(self.directory, filename)),
+            "sha256": digest,
+            "downloaded": downloaded,
+        }
+        self._versions[(package, version)] = filename
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                index = json.load(f)
+            self.files = index["files"]
+        except (IOError, ValueError, KeyError):
+            self.files = {}
+        self._versions = dict(((e["package"], e["version"]), f) for f, e in self.files.items())
+
+    def _save(self):
+        self._versions = dict(((e["package"], e["version"]), f) for f, e in self.files.items())
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump({"files": self.files}, f)
+        os.rename(self.filename + ".tmp", self.filename)
+
+
+class RetentionPolicy(object):
+    """Which downloaded versions of a content package to keep
+
+    A version is kept when it is one of the keep_last newest versions, was
+    downloaded less than keep_days days ago, or is pinned. The newest
+    version is always kept, and with neither keep_last nor keep_days set
+    nothing is pruned at all. Versions are ordered by the numbers in their
+    '-578-2874' style suffix.
+    """
+
+    def __init__(self, keep_last=0, keep_days=0, pinned=()):
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+        self.pinned = set(pinned)
+
+    def configure(self, options):
+        """Update the policy from the options of a config file section"""
+        if options.get("keep_last"):
+            self.keep_last = int(options["keep_last"])
+        if options.get("keep_days"):
+            self.keep_days = float(options["keep_days"])
+        if options.get("pinned"):
+            self.pinned.update(v.strip() for v in options["pinned"].split(",") if v.strip())
+        if options.get("pinned_file"):
+            # Versions pinned by sites, one per line
+            with open(options["pinned_file"]) as f:
+                self.pinned.update(line.strip() for line in f if line.strip())
+
+    def expired(self, entries):
+        """Filenames to prune from a dict of index entries of one package"""
+        if not self.keep_last and not self.keep_days:
+            return []
+        ordered = sorted(entries.items(), key=lambda item: version_key(item[1]["version"]), reverse=True)
+        cutoff = time.time() - self.keep_days * 86400
+        expired = []
+        for position, (filename, entry) in enumerate(ordered):
+            if position == 0 or position < self.keep_last:
+                continue
+            if self.keep_days and entry["downloaded"] >= cutoff:
+                continue
+            if entry["version"] in self.pinned:
+                continue
+            expired.append(filename)
+        return sorted(expired)
+
+
+def prune(index, policies, dry_run=False):
+    """Delete the downloaded versions the retention policies don't keep
+
+    policies maps package names to RetentionPolicy. Checksum sidecars are
+    deleted along with the files. With dry_run, nothing is deleted. Returns
+    the filenames pruned, or that would have been pruned.
+    """
+    index.reconcile()
+    pruned = []
+    for package, policy in sorted(policies.items()):
+        prefix = ContentDownloader.get_prefix(package)
+        entries = dict((f, e) for f, e in index.files.items() if e["package"] == prefix)
+        for filename in policy.expired(entries):
+            pruned.append(filename)
+            if dry_run:
+                logging.info("Would prune %s" % filename)
+                continue
+            logging.info("Pruning %s" % filename)
+            path = os.path.join(index.directory, filename)
+            for name in (path, path + ".sha256"):
+                if os.path.exists(name):
+                    os.remove(name)
+            index.remove(filename)
+    if pruned and not dry_run and ContentDownloader.store is not None:
+        ContentDownloader.store.collect([index.directory])
+    return pruned
+
+
+class ContentStore(object):
+    """Content-addressed store deduplicating downloaded files
+
+    Every file is kept once, as objects/<2 hex digits>/<SHA-256> in the
+    store directory, and the downloaded filenames are hard or symbolic
+    links to it. So a duplicate can be noticed before it is downloaded,
+    the objects are also indexed by their size and the SHA-256 of their
+    first and last PARTIAL_SIZE bytes (see partial_key()). Hard links need
+    the store on the same file system as the download directories.
+
+    Every directory a file is linked to is recorded in directories.json,
+    so collect() can find the symbolic links of every downloader using
+    the store.
+    """
+
+    PARTIAL_SIZE = 1024 * 1024
+    LINKS = ("hard", "symbolic")
+
+    def __init__(self, directory, links="hard"):
+        if links not in self.LINKS:
+            raise ValueError("Unknown link type: %s" % links)
+        self.directory = directory
+        self.links = links
+        self.partial_file = os.path.join(directory, "partial.json")
+        self.directories_file = os.path.join(directory, "directories.json")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = FileLock(os.path.join(directory, ".lock"))
+        with self.lock:
+            if not os.path.exists(self.directories_file):
+                # A store from before directories were recorded may have
+                # symbolic links anywhere
+                self._save_directories([], not os.path.isdir(os.path.join(directory, "objects")))
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    @staticmethod
+    def partial_key(size, head, tail):
+        return "%d:%s:%s" % (size, hashlib.sha256(head).hexdigest(), hashlib.sha256(tail).hexdigest())
+
+    def find(self, size, head, tail):
+        """Digest of the stored object of this size, head and tail, or None"""
+        with self.lock:
+            digest = self._load_partial().get(self.partial_key(size, head, tail))
+        if digest is not None and self.has(digest):
+            return digest
+        return None
+
+    def add(self, filename, digest):
+        """Store a downloaded file and replace it by a link to the object
+
+        Returns True if the content was already stored.
+        """
+        path = self.object_path(digest)
+        with self.lock:
+            if os.path.exists(path):
+                self.link(digest, filename)
+                return True
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if self.links == "hard":
+                os.link(filename, path)
+            else:
+                os.rename(filename, path)
+                self.link(digest, filename)
+            size = os.path.getsize(path)
+            if size > 2 * self.PARTIAL_SIZE:
+                with open(path, "rb") as f:
+                    head = f.read(self.PARTIAL_SIZE)
+                    f.seek(size - self.PARTIAL_SIZE)
+                    tail = f.read()
+                partial = self._load_partial()
+                partial[self.partial_key(size, head, tail)] = digest
+                self._save_partial(partial)
+        return False
+
+    def link(self, digest, filename):
+        """Make filename a link to a stored object, replacing any file there"""
+        linkname = filename + ".tmp"
+        if os.path.lexists(linkname):
+            os.remove(linkname)
+        with self.lock:
+            directories, complete = self._load_directories()
+            directory = os.path.dirname(os.path.abspath(filename))
+            if directory not in directories:
+                self._save_directories(directories + [directory], complete)
+        if self.links == "hard":
+            os.link(self.object_path(digest), linkname)
+        else:
+            os.symlink(os.path.abspath(self.object_path(digest)), linkname)
+        os.rename(linkname, filename)
+
+    def collect(self, directories=()):
+        """Delete the objects no file links to any more. Returns how many
+
+        An object is in use while it has other hard links, or a symbolic
+        link to it is in one of the directories recorded by link() or
+        given. With symbolic links, if the store was used before directories
+        were recorded, objects with no other hard links are all kept.
+        """
+        removed = 0
+        with self.lock:
+            recorded, complete = self._load_directories()
+            existing = [directory for directory in recorded if os.path.isdir(directory)]
+            if existing != recorded:
+                self._save_directories(existing, complete)
+            referenced = set()
+            for directory in set(existing) | set(os.path.abspath(d) for d in directories):
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    if os.path.islink(path):
+                        referenced.add(os.path.realpath(path))
+            for root, dirs, files in os.walk(os.path.join(self.directory, "objects")):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if os.stat(path).st_nlink > 1 or os.path.realpath(path) in referenced:
+                        continue
+                    if not complete and self.links == "symbolic":
+                        logging.debug("Keeping %s, it may have symbolic links in unknown directories" % name)
+                        continue
+                    logging.info("Removing unused object %s from store" % name)
+                    os.remove(path)
+                    removed += 1
+            if removed:
+                partial = self._load_partial()
+                self._save_partial(dict((key, digest) for key, digest in partial.items() if self.has(digest)))
+        return removed
+
+    def _load_partial(self):
+        try:
+            with open(self.partial_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _load_directories(self):
+        """Directories linking to the store, and whether that is all of them"""
+        try:
+            with open(self.directories_file) as f:
+                recorded = json.load(f)
+            return recorded["directories"], recorded["complete"]
+        except (IOError, ValueError, KeyError):
+            return [], False
+
+    def _save_directories(self, directories, complete):
+        with open(self.directories_file + ".tmp", "w") as f:
+            json.dump({"directories": directories, "complete": complete}, f)
+        os.rename(self.directories_file + ".tmp", self.directories_file)
+
+    def _save_partial(self, partial):
+        with open(self.partial_file + ".tmp", "w") as f:
+            json.dump(partial, f)
+        os.rename(self.partial_file + ".tmp", self.partial_file)
+
+
+class LinkScanner(HTMLParser.HTMLParser):
+    """Incremental parser yielding the links of a page while it is read
+
+    Also notices the pages the portal serves instead of the requested one
+    when we are not logged in, and sets needs_login when it sees one.
+    """
+
+    # Size of the chunks read from the response
+    READ_SIZE = 64 * 1024
+    # A published checksum shown after a link, SHA-256 or MD5
+    CHECKSUM_REGEX = re.compile(r"\b([0-9a-fA-F]{64}|[0-9a-fA-F]{32})\b")
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.needs_login = False
+        self._links = []
+        self._tag = None
+        self._href = None
+        self._text = []
+
+    def scan(self, response):
+        """Generate (url, text, checksum) of each link, reading response in chunks
+
+        checksum is the first hex digest in the text between the link and
+        the next one, or None. The last link seen is held back until that
+        text has been read.
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        try:
+            while not self.needs_login:
+                chunk = response.read(self.READ_SIZE)
+                if not chunk:
+                    self.feed(decoder.decode("", True))
+                    self.close()
+                else:
+                    self.feed(decoder.decode(chunk))
+                ready = self._links if not chunk else self._links[:-1]
+                for link in ready:
+                    yield tuple(link)
+                del self._links[:len(ready)]
+                if not chunk:
+                    break
+        finally:
+            response.close()
+
+    def handle_starttag(self, tag, attrs):
+        self._tag = tag
+        if tag == "a":
+            self._href = dict(attrs).get("href")
+            self._text = []
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._href is not None:
+            self._links.append([self._href, " ".join("".join(self._text).split()), None])
+            self._href = None
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+        elif self._links and self._links[-1][2] is None:
+            match = self.CHECKSUM_REGEX.search(data)
+            if match is not None:
+                self._links[-1][2] = match.group(1)
+        if self._tag == "h1" and data.strip() == "Single Sign On":
+            logging.debug("Got single sign on page")
+            self.needs_login = True
+        elif self._tag == "h4" and data.strip() == "You are not authorized to perform this action.":
+            logging.debug("Got not authorized page")
+            self.needs_login = True
+        elif data.find("An unexpected error has occurred.") != -1:
+            logging.debug("Got unexpected error page")
+            self.needs_login = True
+
+
+class PageCache(object):
+    """On-disk conditional GET cache for the update listing pages
+
+    For each page URL only the validators sent by the server (ETag and
+    Last-Modified), the time of the last fetch and the result parsed from
+    the page are kept, all in one JSON file. Entries younger than ttl
+    seconds are used without asking the server at all.
+    """
+
+    def __init__(self, filename="listing_cache.json", ttl=0):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched"] < self.ttl
+
+    @staticmethod
+    def validators(entry):
+        headers = []
+        if entry.get("etag"):
+            headers.append(("If-None-Match", entry["etag"]))
+        if entry.get("last_modified"):
+            headers.append(("If-Modified-Since", entry["last_modified"]))
+        return headers
+
+    def put(self, url, headers, parsed):
+        with self._lock:
+            self.entries[url] = {
+                "etag": headers.getheader("ETag"),
+                "last_modified": headers.getheader("Last-Modified"),
+                "fetched": time.time(),
+                "parsed": parsed,
+            }
+            self._save()
+
+    def touch(self, url):
+        with self._lock:
+            self.entries[url]["fetched"] = time.time()
+            self._save()
+
+    def _save(self):
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.rename(self.filename + ".tmp", self.filename)
+
+
+class ChangeFeed(object):
+    """JSON lines log of the versions added to and removed from a listing
+
+    Each line has the time, the source of the listing and, for every group
+    of versions (a package or a software family) that changed, the versions
+    added and removed, and is only appended when something changed. The
+    versions last seen of each source are kept in filename + '.snapshot',
+    to diff the next listing against.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = FileLock(filename + ".lock")
+
+    @staticmethod
+    def diff(old, new):
+        """{group: {"added": [...], "removed": [...]}} of the groups whose versions changed"""
+        changes = {}
+        for group in set(old) | set(new):
+            before = set(old.get(group, ()))
+            after = set(new.get(group, ()))
+            if before != after:
+                changes[group] = {
+                    "added": sorted(after - before, key=version_key),
+                    "removed": sorted(before - after, key=version_key),
+                }
+        return changes
+
+    def append(self, source, changes):
+        """Append a line with the changes of source, if any. Returns True if appended"""
+        if not changes:
+            return False
+        line = json.dumps({"time": round(time.time(), 3), "source": source, "changes": changes},
+                          sort_keys=True, separators=(",", ":"))
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(line + "\n")
+        return True
+
+    def update(self, source, versions):
+        """Diff the versions of each group of source with the last ones and append the changes
+
+        The first listing of a source is only remembered, as there is
+        nothing to diff it against. Returns the changes.
+        """
+        with self.lock:
+            try:
+                with open(self.filename + ".snapshot") as f:
+                    snapshots = json.load(f)
+            except (IOError, ValueError):
+                snapshots = {}
+            old = snapshots.get(source)
+            changes = {} if old is None else self.diff(old, versions)
+            if old is None or changes:
+                snapshots[source] = versions
+                with open(self.filename + ".snapshot.tmp", "w") as f:
+                    json.dump(snapshots, f)
+                os.rename(self.filename + ".snapshot.tmp", self.filename + ".snapshot")
+            self.append(source, changes)
+        return changes
+
+
+class FormParser(HTMLParser.HTMLParser):
+    """Collects the forms of a page and the controls in them"""
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.forms = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.forms.append(Form(attrs.get("action"), attrs.get("method", "get")))
+        elif self.forms and tag in ("input", "button", "select", "textarea"):
+            kind = attrs.get("type", "submit" if tag == "button" else "text").lower()
+            if kind in ("checkbox", "radio") and "checked" not in attrs:
+                return
+            self.forms[-1].add(attrs.get("name"), attrs.get("value", ""), kind)
+
+
+class Form(object):
+    """An HTML form, enough of mechanize's HTMLForm for the login pages"""
+
+    def __init__(self, action, method):
+        self.action = action
+        self.method = method.upper()
+        self.controls = []
+
+    def add(self, name, value, kind):
+        if name is not None:
+            self.controls.append([name, value, kind])
+
+    def __getitem__(self, name):
+        for control in self.controls:
+            if control[0] == name:
+                return control[1]
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        for control in self.controls:
+            if control[0] == name:
+                control[1] = value
+                return
+        raise KeyError("No control named %s in form" % name)
+
+    def data(self):
+        """Form data as submitted by clicking its first submit button"""
+        fields = []
+        clicked = False
+        for name, value, kind in self.controls:
+            if kind in ("submit", "image"):
+                if clicked:
+                    continue
+                clicked = True
+            elif kind in ("reset", "file"):
+                continue
+            fields.append((name, value))
+        return urllib.urlencode(fields)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections shared by the browsers of a downloader"""
+
+    # Idle connections kept per host
+    SIZE = 8
+    TIMEOUT = 60
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._proxies = urllib.getproxies()
+
+    def get(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        host, port = urllib.splitport(netloc)
+        port = int(port) if port else None
+        proxy = self._proxies.get(scheme)
+        if proxy is not None and not urllib.proxy_bypass(host):
+            proxyhost = urlparse.urlparse(proxy).netloc
+            if scheme == "https":
+                connection = httplib.HTTPSConnection(proxyhost, timeout=self.TIMEOUT)
+                connection.set_tunnel(host, port)
+            else:
+                connection = httplib.HTTPConnection(proxyhost, timeout=self.TIMEOUT)
+                connection.proxied = True
+        elif scheme == "https":
+            connection = httplib.HTTPSConnection(host, port, timeout=self.TIMEOUT)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self.TIMEOUT)
+        if self.debug:
+            connection.set_debuglevel(1)
+        return connection
+
+    def put(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.SIZE:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+class PooledResponse(object):
+    """Streamed response of a PooledBrowser
+
+    The connection goes back to the pool once the body has been read to
+    the end, and is closed if the response is closed before that.
+    """
+
+    def __init__(self, url, response, release):
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self._response = response
+        self._release = release
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, size=None):
+        data = self._response.read(size) if size is not None else self._response.read()
+        if self._release is not None and self._response.isclosed():
+            self._release(not self._response.will_close)
+            self._release = None
+        return data
+
+    def close(self):
+        if self._release is not None:
+            self._response.close()
+            self._release(False)
+            self._release = None
+
+
+class PooledBrowser(object):
+    """HTTP client without mechanize, using keep-alive connections
+
+    Implements the parts of mechanize.Browser that ContentDownloader uses:
+    open(), open_novisit(), response(), select_form(), form and submit().
+    Cookies go to and from the downloader's cookie jar, and redirects are
+    followed. Like mechanize, responses outside 2xx raise HTTPError.
+    """
+
+    MAX_REDIRECTS = 10
+
+    def __init__(self, cookiejar, pool, headers=()):
+        self.cj = cookiejar
+        self.pool = pool
+        self.headers = list(headers)
+        self.form = None
+        self._response = None
+        self._url = None
+
+    def open(self, url_or_request, data=None):
+        response = self.open_novisit(url_or_request, data)
+        body = response.read()
+        self._url = response.geturl()
+        self._response = (response.code, response.msg, response.info(), body)
+        self.form = None
+        return self.response()
+
+    def open_novisit(self, url_or_request, data=None):
+        if isinstance(url_or_request, basestring):
+            request = urllib2.Request(url_or_request, data)
+        else:
+            request = url_or_request
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            response = self._send(request)
+            if response.code not in (301, 302, 303, 307) or response.info().getheader("Location") is None:
+                break
+            response.read()
+            url = urlparse.urljoin(request.get_full_url(), response.info().getheader("Location"))
+            # Like urllib2.HTTPRedirectHandler, only the redirected headers
+            # are sent again, and the cookies for the new URL come from the jar
+            dropped = ("cookie", "host")
+            if response.code == 307:
+                headers = dict((k, v) for k, v in request.headers.items() if k.lower() not in dropped)
+                request = urllib2.Request(url, request.get_data(), headers)
+            else:
+                dropped += ("content-type", "content-length", "range")
+                headers = dict((k, v) for k, v in request.headers.items() if k.lower() not in dropped)
+                request = urllib2.Request(url, headers=headers)
+        if not 200 <= response.code < 300:
+            body = StringIO.StringIO(response.read())
+            raise urllib2.HTTPError(response.geturl(), response.code, response.msg, response.info(), body)
+        return response
+
+    def response(self):
+        code, msg, headers, body = self._response
+        response = urllib.addinfourl(StringIO.StringIO(body), headers, self._url, code)
+        response.msg = msg
+        return response
+
+    def select_form(self, nr=0):
+        parser = FormParser()
+        parser.feed(self._response[3].decode("utf-8", "replace"))
+        parser.close()
+        if len(parser.forms) <= nr:
+            raise LookupError("No form number %d on %s" % (nr, self._url))
+        self.form = parser.forms[nr]
+
+    def submit(self):
+        url = urlparse.urljoin(self._url, self.form.action or self._url)
+        if self.form.method == "POST":
+            request = urllib2.Request(url, self.form.data(), {"Content-Type": "application/x-www-form-urlencoded"})
+        else:
+            request = urllib2.Request(url.split("?")[0] + "?" + self.form.data())
+        request.add_header("Referer", self._url)
+        return self.open(request)
+
+    def _send(self, request):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(request.get_full_url())
+        for name, value in self.headers:
+            if not request.has_header(name):
+                request.add_header(name, value)
+        self.cj.add_cookie_header(request)
+        target = urlparse.urlunsplit(("", "", path or "/", query, ""))
+        for attempt in range(2):
+            connection = self.pool.get(scheme, netloc)
+            if getattr(connection, "proxied", False):
+                target = request.get_full_url()
+            try:
+                connection.request(request.get_method(), target, request.get_data(),
+                                   dict(request.header_items()))
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # An idle connection may have been closed by the server,
+                # retry once on a fresh one
+                if attempt:
+                    raise
+
+        def release(reuse):
+            if reuse:
+                self.pool.put(scheme, netloc, connection)
+            else:
+                connection.close()
+
+        response = PooledResponse(request.get_full_url(), response, release)
+        self.cj.extract_cookies(response, request)
+        return response
+
+
 class ContentDownloader(object):
     """Checks for new content packages and downloads the latest"""
 
@@ -81,11 +1447,47 @@ class ContentDownloader(object):
         "wildfire2": "wildfire/panupv2-all-wildfire",
     }
 
+    USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36"
+    # HTTP clients: "mechanize", or "pooled" for PooledBrowser
+    BACKENDS = ("mechanize", "pooled")
+
+    DOWNLOAD_URL = "https://downloads.paloaltonetworks.com/"
     SUPPORT_URL = "https://support.paloaltonetworks.com"
     UPDATE_URL = "https://support.paloaltonetworks.com/Updates/DynamicUpdates"
     SOFTWARE_URL = "https://support.paloaltonetworks.com/Updates/SoftwareUpdates/"
-    
-    def __init__(self, username, password, package="appthreat", debug=False):
+
+    # Number of concurrent transfers used by download_files()
+    DOWNLOAD_WORKERS = 4
+    # Size of the chunks streamed from the network to disk
+    CHUNK_SIZE = 1024 * 1024
+    # Content packages get bandwidth before software images
+    PRIORITY_CONTENT = 1
+    PRIORITY_SOFTWARE = 0
+    # TokenBucket shared by the transfers of every downloader, if limited
+    throttle = None
+    # URL of the hub content updates are taken from instead of the portal
+    hub = None
+    # Metrics shared by every downloader
+    metrics = Metrics()
+    # RetryPolicy shared by every request of every downloader
+    retry = RetryPolicy()
+    # ContentStore shared by every downloader, if deduplicating
+    store = None
+    # PushPipeline every downloaded file is handed to, if pushing to firewalls
+    pipeline = None
+    # ChangeFeed the versions added to and removed from the listing are logged to, if any
+    feed = None
+    # Number of parallel byte ranges used by retrieve_segmented()
+    DOWNLOAD_SEGMENTS = 4
+    # Files smaller than this are always downloaded as a single stream
+    SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+    # Largest byte range fetched by one request of retrieve_segmented()
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    # Data downloaded ahead of the hashed part of a file kept in memory for hashing
+    HASH_BUFFER = 64 * 1024 * 1024
+
+    def __init__(self, username, password, package="appthreat", debug=False, cookiefile="cookies.txt", cache=None,
+                 backend="mechanize", accounts=()):
         if package is None:
             package = "appthreat"
         if package not in self.PACKAGE:
@@ -94,20 +1496,89 @@ class ContentDownloader(object):
         self.password = password
         self.package = package
         self.path = self.PACKAGE[package]
-        self.prefix = self.path.split("/")[-1]
+        self.prefix = self.get_prefix(package)
+        self.debug = debug
         self.latestversion = None
         self.fileurl = None
-        self.cj = cookielib.LWPCookieJar()
-        try:
-            self.cj.load("cookies.txt", ignore_discard=True, ignore_expires=True)
-        except IOError:
-            # Ignore if there are no cookies to load
-            logging.debug("No existing cookies found")
-            pass
-        self.browser = self.get_browser(debug)
+        self.cache = cache
+        self.listing_cached = False
+        self.listing_headers = None
+        # Published checksums of the listed files, by URL without query
+        self.checksums = {}
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown backend: %s" % backend)
+        self.backend = backend
+        self.pool = ConnectionPool(debug)
+        self.cookiefile = cookiefile
+        # The cookies are loaded and the browser built only once a request
+        # is made, which a check answered from the listing cache never does
+        self._session = None
+        self._session_loaded = False
+        self._session_lock = threading.Lock()
+        self._browser = None
+        # This downloader and one for each other support account
+        self.accounts = [self]
+        # (downloader, link) of the accounts entitled to each listed file, by URL without query
+        self.entitlements = {}
+        # Accounts whose releases are missing from the last merged listing
+        self.failed_accounts = []
+        self._busy = {}
+        self._busy_lock = threading.Lock()
+        for account_username, account_password in accounts:
+            self.add_account(account_username, account_password, cookiefile)
+
+    def add_account(self, username, password, cookiefile="cookies.txt"):
+        """Add another support account to list and download software with
+
+        The account gets its own cookie jar, session and listing cache,
+        named after its username, but shares the download directory
+        indexes with this downloader.
+        """
+        cache = None
+        if self.cache is not None:
+            cache = PageCache(account_filename(self.cache.filename, username), self.cache.ttl)
+        account = ContentDownloader(username, password, self.package, self.debug,
+                                    account_filename(cookiefile, username), cache, self.backend)
+        account._indexes = self._indexes
+        account._indexes_lock = self._indexes_lock
+        self.accounts.append(account)
+        return account
+
+    @property
+    def session(self):
+        """SessionManager of this downloader's cookie jar, created on first use"""
+        if self._session is None:
+            # Imported here as cookielib compiles dozens of regexes on import
+            import cookielib
+            self._session = SessionManager(cookielib.LWPCookieJar(), self.cookiefile)
+        return self._session
+
+    @property
+    def cj(self):
+        return self.session.cj
+
+    @property
+    def browser(self):
+        """Browser of this downloader, built on first use"""
+        if self._browser is None:
+            self._browser = self.get_browser(self.debug)
+        return self._browser
+
+    def _load_session(self):
+        """Load the saved cookies, once, before the first request"""
+        with self._session_lock:
+            if not self._session_loaded:
+                with self.metrics.timer("cookie_load"):
+                    self.session.load()
+                self._session_loaded = True
 
     def get_browser(self, debug=False):
-        br = mechanize.Browser()
+        self._load_session()
+        if self.backend == "pooled":
+            return PooledBrowser(self.cj, self.pool, [("User-Agent", self.USER_AGENT)])
+        br = import_mechanize().Browser()
         # Cookie Jar
         br.set_cookiejar(self.cj)
         # Browser options
@@ -117,7 +1588,7 @@ class ContentDownloader(object):
         br.set_handle_referer(True)
         br.set_handle_robots(False)
         br.addheaders = [
-            ("User-Agent", "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36"),
+            ("User-Agent", self.USER_AGENT),
         ]
         if debug:
             br.set_debug_http(True)
@@ -125,118 +1596,1322 @@ class ContentDownloader(object):
             br.set_debug_responses(True)
         return br
 
+    def _new_request(self, url):
+        if self.backend == "pooled":
+            return urllib2.Request(url)
+        return import_mechanize().Request(url)
+
+    def _request(self, phase, what, function, *args):
+        """function(*args), retried on transient failures by the shared RetryPolicy"""
+        return self.retry.call(phase, what, self.metrics, function, *args)
+
     def login(self):
         logging.info("Logging in")
-        self.browser.open(self.SUPPORT_URL)
+        self.metrics.count("logins")
+        with self.metrics.timer("login"):
+            # A failed login is started over from the login page
+            self._request("login", "Login", self._submit_login)
+        # Save login cookie
+        self.session.logged_in()
+        self._save_cookies()
+
+    def _submit_login(self):
+        with self.metrics.timer("login_request", step="page"):
+            self.browser.open(self.SUPPORT_URL)
         self.browser.select_form(nr=0)
         self.browser.form['Email'] = self.username
         self.browser.form['Password'] = self.password
-        self.browser.submit()
+        with self.metrics.timer("login_request", step="credentials"):
+            self.browser.submit()
         # No Javascript, so have to submit the "Resume form"
         self.browser.select_form(nr=0)
-        self.browser.submit()
+        with self.metrics.timer("login_request", step="resume"):
+            self.browser.submit()
         html = self.browser.response().read()
         if html.find("Welcome") == -1:
+            self.metrics.count("login_failures")
             raise LoginError("Failed to login")
-        # Save login cookie
-        self._save_cookies()
 
-    def check(self):
+    def ensure_login(self):
+        """Log in before the next request if the login has expired
+
+        Logging in up front saves fetching a page only to find out that
+        we are logged out. Another run may have logged in while we waited
+        for the cookie file lock, so the cookies are reloaded first.
+        """
+        if self.hub is not None:
+            return
+        self._load_session()
+        if self.session.is_valid():
+            return
+        with self.session.lock:
+            self.session.load()
+            if not self.session.is_valid():
+                self.login()
+
+    @classmethod
+    def use_hub(cls, url):
+        """Check and download content updates from a HubServer at url
+
+        The hub lists and serves the packages at the same paths as the
+        portal and the download server, and needs no login.
+        """
+        if not url.endswith("/"):
+            url += "/"
+        cls.hub = url
+        cls.DOWNLOAD_URL = url
+        cls.UPDATE_URL = url + HubServer.LISTING_PATH.lstrip("/")
+
+    @classmethod
+    def get_prefix(cls, package):
+        """Filename prefix of a package, eg. 'panupv2-all-contents'"""
+        return cls.PACKAGE[package].split("/")[-1]
+
+    def check(self, use_cache=True):
         logging.info("Checking for new content updates: %s" % self.package)
-        result = self._check()
-        needlogin = False
-        if result.find("<h1>Single Sign On</h1>") != -1:
-            needlogin = True
-            logging.debug("Got single sign on page")
-        elif result.find("<h4>You are not authorized to perform this action.</h4>") != -1:
-            needlogin = True
-            logging.debug("Got not authorized page")
-        if needlogin:
-            logging.info("Not logged in.")
-            self.login()
-            logging.info("Checking for new content updates (2nd attempt)")
-            result = self._check()
-        file_url = "https://downloads.paloaltonetworks.com/" + self.path
-        try:
-            # Grab the first link that matches the regex,
-            # which is the download link for the first dynamic update
-            url = list(self.browser.links(url_regex=file_url))[0].url
-        except IndexError:
-            raise UpdateError("Unable to get content update list")
-        # Add the version to the regex to extract the latest version number
-        file_regex = file_url + "-([\d-]*)\?"
-        # Get the version
-        version = re.search(file_regex, url).group(1)
+        version, url = self.check_packages([self.package], use_cache)[self.package]
         self.latestversion = version
         self.fileurl = url
         return version, url
 
-    def _check(self):
-        self.browser.open(self.UPDATE_URL)
-        return self.browser.response().read()
+    def check_packages(self, packages, use_cache=True):
+        """Check the latest version of several packages at once
+
+        The DynamicUpdates page is fetched (and login done) only once, and the
+        download link of every requested package is taken from that page.
+        Returns a dict mapping each package to a (version, url) tuple.
+        """
+        for package in packages:
+            if package not in self.PACKAGE:
+                raise UnknownPackage("Unknown package type: %s" % package)
+        logging.info("Checking for new content updates: %s" % ", ".join(packages))
+        # Without a cache there is no need to read past the requested packages
+        wanted = packages if self.cache is None else self.PACKAGE
+        # Every version of every package, for the change feed
+        versions = {} if self.feed is not None else None
+
+        def parse(links):
+            if versions is not None:
+                versions.clear()
+            listing = self._parse_updates(links, wanted, versions)
+            # Most likely a page the portal failed to fill, read it again
+            if not all(package in listing for package in packages):
+                raise UpdateError("Unable to get content update list")
+            return listing
+
+        listing = self._get_listing(self.UPDATE_URL, parse, use_cache)
+        # Nothing is parsed when the cached listing is still current
+        if versions:
+            self.feed.update("content", versions)
+        updates = {}
+        for package in packages:
+            if package not in listing:
+                raise UpdateError("Unable to get content update list")
+            entry = listing[package]
+            updates[package] = (entry[0], entry[1])
+            self._published_checksum(entry)
+        return updates
+
+    def _published_checksum(self, entry):
+        """Remember the checksum listed with a link for when it is downloaded"""
+        if len(entry) > 2 and entry[-1] is not None:
+            self.checksums[entry[-2].split("?")[0]] = entry[-1]
+
+    def _get_listing(self, url, parse, use_cache=True):
+        """Fetch a listing page and parse its links, using the page cache if any
+
+        parse gets a generator of the (url, text) links on the page and may
+        stop consuming it as soon as it has found what it needs. A cached
+        result is returned without any request while it is younger than the
+        cache TTL, and after that as long as the portal answers a conditional
+        GET with 304 Not Modified. self.listing_cached tells whether the
+        result came from the cache, in which case the download links in it
+        may have expired. Fetching and parsing are retried together, also
+        when parse raises UpdateError.
+        """
+        entry = None
+        if self.cache is not None and use_cache:
+            entry = self.cache.get(url)
+            if entry is not None and self.cache.is_fresh(entry):
+                logging.info("Using cached listing of %s" % url)
+                self.metrics.count("cache_hits")
+                self.listing_cached = True
+                return entry["parsed"]
+        self.ensure_login()
+        return self._request("listing", "Listing of %s" % url.split("?")[0], self._fetch_listing, url, parse, entry)
+
+    def _fetch_listing(self, url, parse, entry):
+        with self.metrics.timer("listing_fetch", url=url.split("?")[0]) as fields:
+            response = self._open_listing(url, entry)
+            fields["not_modified"] = response is None
+        if response is None:
+            logging.info("Listing of %s not modified" % url)
+            self.metrics.count("cache_not_modified")
+            self.cache.touch(url)
+            self.listing_cached = True
+            return entry["parsed"]
+        if self.cache is not None:
+            self.metrics.count("cache_misses")
+        with self.metrics.timer("listing_parse", url=url.split("?")[0]):
+            parsed = parse(self._scan_listing(url, response))
+        if self.cache is not None:
+            self.cache.put(url, self.listing_headers, parsed)
+        self.listing_cached = False
+        return parsed
+
+    def _open_listing(self, url, entry=None):
+        """Open a listing page, returning None if the cached entry is current"""
+        request = self._new_request(url)
+        if entry is not None:
+            for header, value in self.cache.validators(entry):
+                request.add_header(header, value)
+        try:
+            response = self.browser.open_novisit(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and entry is not None:
+                return None
+            raise
+        self.listing_headers = response.info()
+        return response
+
+    def _scan_listing(self, url, response):
+        """Generate the links of a listing page while it is read
+
+        Logs in and reads the page again if the portal sent a login page.
+        """
+        scanner = LinkScanner()
+        for link in scanner.scan(response):
+            yield link
+        if scanner.needs_login:
+            logging.info("Not logged in.")
+            self.metrics.count("relogins")
+            self.metrics.event("relogin", url=url.split("?")[0])
+            self.session.invalidate()
+            self.ensure_login()
+            logging.info("Checking for new content updates (2nd attempt)")
+            for link in LinkScanner().scan(self._open_listing(url)):
+                yield link
+
+    def _parse_updates(self, links, packages, versions=None):
+        """Latest [version, url] of packages on the DynamicUpdates page
+
+        The first link of a package is the download link of its latest
+        version, so reading stops once every package has been found. If a
+        versions dict is given, the whole page is read instead, and every
+        version listed of every package is collected in it.
+        """
+        regexes = {}
+        for package in (packages if versions is None else self.PACKAGE):
+            file_url = self.DOWNLOAD_URL + self.PACKAGE[package]
+            # Add the version to the regex to extract the latest version number
+            regexes[package] = re.compile(file_url + "-([\d-]*)\?")
+        updates = {}
+        for url, text, checksum in links:
+            for package, regex in regexes.items():
+                match = regex.search(url)
+                if match is None:
+                    continue
+                if package in packages and package not in updates:
+                    updates[package] = [match.group(1), url, checksum]
+                if versions is None:
+                    del regexes[package]
+                else:
+                    versions.setdefault(package, []).append(match.group(1))
+            if not regexes:
+                break
+        for package in packages:
+            if package not in updates:
+                logging.debug("No updates found for package: %s" % package)
+        return updates
 
     def download(self, download_dir):
         if self.latestversion is not None and self.fileurl is not None:
-            os.chdir(download_dir)
             filename = self.prefix+"-"+self.latestversion
-            self.browser.retrieve(self.fileurl, filename)
+            self.retrieve(self.fileurl, os.path.join(download_dir, filename))
             return filename
 
+    def retrieve(self, url, filename, browser=None, priority=PRIORITY_CONTENT):
+        """Download url to filename, resuming after dropped connections
+
+        The data is streamed in chunks to filename + '.part'. If the transfer
+        fails partway, it is resumed with a Range request so only the missing
+        bytes are fetched again. The part file is renamed to filename only
+        once the download is complete.
+
+        The SHA-256 of the data is computed while it is written, checked
+        against the published checksum if the listing had one, and recorded
+        in filename + '.sha256'. ChecksumError is raised on a mismatch.
+        """
+        if browser is None:
+            browser = self.browser
+        partname = filename + ".part"
+        if os.path.exists(partname + ".segments"):
+            # Left behind by retrieve_segmented(), the part file is sparse
+            # and can't be resumed as a single stream
+            logging.info("Discarding segmented part file for %s" % os.path.basename(filename))
+            os.remove(partname)
+            os.remove(partname + ".segments")
+        checksum = self.checksums.get(url.split("?")[0])
+        if self.store is not None and not os.path.exists(partname):
+            if self._link_duplicate(browser, url, filename, checksum, priority, partname):
+                return filename
+        digest = StreamDigest(md5=checksum is not None and len(checksum) == 32)
+        began = time.time()
+        with self.metrics.timer("download", file=os.path.basename(filename), segments=1) as fields:
+            with self._transfer(priority):
+                # Every retry resumes where the part file ends
+                received = self._request("download", "Download of %s" % os.path.basename(filename),
+                                         self._retrieve_part, browser, url, partname, digest, priority)
+            self._complete(partname, filename, digest, checksum)
+            self._download_stats(fields, received, began)
+        return filename
+
+    def _link_duplicate(self, browser, url, filename, checksum, priority, partname=None):
+        """Link filename to a stored copy of url instead of downloading it
+
+        A published SHA-256 is looked up in the store directly. Otherwise
+        the first and last bytes of the file are fetched, and looked up
+        with its size. The first bytes are written to partname, if given,
+        so the download carries on after them. Returns True if filename
+        was linked.
+        """
+        digest = None
+        if checksum is not None and len(checksum) == 64 and self.store.has(checksum.lower()):
+            digest = checksum.lower()
+        else:
+            try:
+                head = self._fetch_range(browser, url, 0, self.store.PARTIAL_SIZE - 1, priority)
+                if head is None:
+                    return False
+                data, size = head
+                if size > 2 * self.store.PARTIAL_SIZE:
+                    tail = self._fetch_range(browser, url, size - self.store.PARTIAL_SIZE, size - 1, priority)
+                    if tail is not None:
+                        digest = self.store.find(size, data, tail[0])
+            except REQUEST_ERRORS as e:
+                logging.warning("Unable to look for a stored copy of %s: %s" % (os.path.basename(filename), e))
+                return False
+            if digest is not None and checksum is not None and not self._stored_matches(digest, checksum):
+                digest = None
+            if digest is None:
+                if partname is not None:
+                    with open(partname, "wb") as f:
+                        f.write(data)
+                return False
+        logging.info("Same content as %s is already stored, linking %s" % (digest, os.path.basename(filename)))
+        try:
+            self.store.link(digest, filename)
+        except (IOError, OSError) as e:
+            # E.g. hard links across file systems, download it instead
+            logging.warning("Unable to link %s to the store: %s" % (os.path.basename(filename), e))
+            return False
+        write_checksum(filename, digest)
+        self.get_index(os.path.dirname(filename)).add(os.path.basename(filename), digest=digest)
+        if self.pipeline is not None:
+            self.pipeline.submit(filename)
+        self.metrics.count("dedup_hits")
+        self.metrics.count("dedup_bytes", os.path.getsize(filename))
+        return True
+
+    def _stored_matches(self, digest, checksum):
+        """Whether the stored object digest has the published checksum"""
+        if len(checksum) == 64:
+            return digest == checksum.lower()
+        stored = StreamDigest(md5=True)
+        path = self.store.object_path(digest)
+        stored.catch_up(path, os.path.getsize(path))
+        return stored.matches(checksum)
+
+    def _fetch_range(self, browser, url, start, end, priority):
+        """(data, file size) of a byte range of url, or None if Range isn't honored"""
+        request = self._new_request(url)
+        request.add_header("Range", "bytes=%d-%d" % (start, end))
+        response = browser.open_novisit(request)
+        try:
+            match = re.match(r"bytes (\d+)-\d+/(\d+)$", response.info().getheader("Content-Range") or "")
+            if response.code != 206 or match is None or int(match.group(1)) != start:
+                return None
+            chunks = []
+            while True:
+                chunk = self._read(response, self.CHUNK_SIZE, priority)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            response.close()
+        return "".join(chunks), int(match.group(2))
+
+    def _download_stats(self, fields, received, began):
+        """Add the bytes received and the transfer rate to download event fields"""
+        elapsed = time.time() - began
+        fields["bytes"] = received
+        fields["bytes_per_second"] = int(received / elapsed) if elapsed > 0 else None
+        self.metrics.count("downloads")
+        self.metrics.count("download_bytes", received)
+
+    def _complete(self, partname, filename, digest, checksum):
+        """Check the digest of a finished part file and move it in place"""
+        if checksum is not None and not digest.matches(checksum):
+            os.remove(partname)
+            raise ChecksumError("Checksum mismatch for %s: expected %s"
+                                % (os.path.basename(filename), checksum))
+        os.rename(partname, filename)
+        write_checksum(filename, digest.hexdigest())
+        if self.store is not None:
+            try:
+                if self.store.add(filename, digest.hexdigest()):
+                    logging.info("Same content as %s was already stored, linked %s"
+                                 % (digest.hexdigest(), os.path.basename(filename)))
+                    self.metrics.count("dedup_late_hits")
+            except (IOError, OSError) as e:
+                logging.warning("Unable to add %s to the store: %s" % (os.path.basename(filename), e))
+        self.get_index(os.path.dirname(filename)).add(os.path.basename(filename), digest=digest.hexdigest())
+        if self.pipeline is not None:
+            self.pipeline.submit(filename)
+
+    def get_index(self, download_dir):
+        """RepositoryIndex of download_dir, shared by all downloads to it"""
+        download_dir = os.path.abspath(download_dir)
+        with self._indexes_lock:
+            if download_dir not in self._indexes:
+                self._indexes[download_dir] = RepositoryIndex(download_dir)
+            return self._indexes[download_dir]
+
+    @contextmanager
+    def _transfer(self, priority):
+        if self.throttle is None:
+            yield
+        else:
+            with self.throttle.transfer(priority):
+                yield
+
+    def _read(self, response, size, priority):
+        """Read up to size bytes from response, within the rate limit if any"""
+        if self.throttle is None:
+            return response.read(size)
+        size = min(size, self.throttle.chunk_size)
+        self.throttle.consume(size, priority)
+        return response.read(size)
+
+    def _retrieve_part(self, browser, url, partname, digest, priority):
+        offset = 0
+        if os.path.exists(partname):
+            offset = os.path.getsize(partname)
+            digest.catch_up(partname, offset)
+        request = self._new_request(url)
+        if offset:
+            request.add_header("Range", "bytes=%d-" % offset)
+        try:
+            response = browser.open_novisit(request)
+        except urllib2.HTTPError as e:
+            if e.code == 416 and offset:
+                # Nothing left to fetch, the part file is already complete
+                return 0
+            raise
+        if offset and response.code != 206:
+            logging.info("Server does not support resuming, restarting download")
+            offset = 0
+            digest.reset()
+        length = response.info().getheader("Content-Length")
+        received = 0
+        try:
+            with open(partname, "ab" if offset else "wb") as f:
+                while True:
+                    chunk = self._read(response, self.CHUNK_SIZE, priority)
+                    if not chunk:
+                        break
+                    self._write(f, chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+        finally:
+            response.close()
+        if length is not None and received < int(length):
+            raise socket.error("Connection closed after %d of %s bytes" % (received, length))
+        return received
+
+    def _write(self, f, chunk):
+        began = time.time()
+        f.write(chunk)
+        self.metrics.count("disk_write_seconds", time.time() - began)
+
+    def retrieve_segmented(self, url, filename, segments=None, browser=None, priority=PRIORITY_SOFTWARE):
+        """Download url to filename over several parallel connections
+
+        The file is split into byte ranges of at most SEGMENT_SIZE, which
+        segments connections fetch concurrently, in order, into a
+        preallocated (sparse) filename + '.part'. The progress of each
+        range is kept in filename + '.part.segments', so an interrupted
+        download resumes every range where it stopped. Falls back to a
+        single stream with retrieve() when the server doesn't honor Range or
+        the file is smaller than SEGMENT_MIN_SIZE.
+
+        The SHA-256 is computed while the ranges arrive, over the part of the
+        file downloaded contiguously from its start. Chunks written past that
+        frontier are kept in memory, up to HASH_BUFFER, until the frontier
+        reaches them. Only what didn't fit is read back from disk. The digest
+        is checked and recorded like in retrieve().
+        """
+        if segments is None:
+            segments = self.DOWNLOAD_SEGMENTS
+        partname = filename + ".part"
+        mapname = partname + ".segments"
+        progress = None
+        if os.path.exists(mapname):
+            with open(mapname) as f:
+                progress = json.load(f)
+            if progress["url"].split("?")[0] != url.split("?")[0] or not os.path.exists(partname):
+                progress = None
+        elif os.path.exists(partname):
+            # Resume a single stream download started by retrieve()
+            return self.retrieve(url, filename, browser, priority)
+        if progress is None:
+            size = self._probe_size(url, browser or self.browser)
+            if size is None or size < self.SEGMENT_MIN_SIZE or segments < 2:
+                return self.retrieve(url, filename, browser, priority)
+            if self.store is not None and self._link_duplicate(browser or self.browser, url, filename,
+                                                               self.checksums.get(url.split("?")[0]), priority):
+                return filename
+            # Ranges are fetched in order, so the data arrives close to the
+            # frontier of the hash
+            step = min(self.SEGMENT_SIZE, -(-size // segments))
+            progress = {
+                "url": url,
+                "size": size,
+                "segments": [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)],
+            }
+            with open(partname, "wb") as f:
+                f.truncate(size)
+            self._save_progress(mapname, progress)
+        progress["url"] = url
+        pending = Queue.Queue()
+        for segment in progress["segments"]:
+            if segment[0] + segment[2] <= segment[1]:
+                pending.put(segment)
+        connections = min(segments, pending.qsize())
+        logging.info("Downloading %s in %d ranges over %d connections"
+                     % (os.path.basename(filename), pending.qsize(), connections))
+
+        lock = threading.Lock()
+        errors = []
+        checksum = self.checksums.get(url.split("?")[0])
+        digest = StreamDigest(md5=checksum is not None and len(checksum) == 32)
+        hash_lock = threading.Lock()
+        # Chunks downloaded past the frontier of the digest, by position
+        ahead = {}
+        buffered = [0]
+
+        def hash_chunk(position, chunk):
+            with hash_lock:
+                if position == digest.size:
+                    digest.update(chunk)
+                elif position > digest.size and buffered[0] + len(chunk) <= self.HASH_BUFFER:
+                    ahead[position] = chunk
+                    buffered[0] += len(chunk)
+                while True:
+                    if digest.size in ahead:
+                        chunk = ahead.pop(digest.size)
+                        buffered[0] -= len(chunk)
+                        digest.update(chunk)
+                        continue
+                    # Read back what is on disk but didn't fit in the buffer
+                    with lock:
+                        end = self._contiguous(progress)
+                    end = min([end] + [start for start in ahead if start > digest.size])
+                    if end <= digest.size:
+                        return
+                    digest.catch_up(partname, end)
+
+        def worker():
+            browser = self.get_browser(self.debug)
+            while not errors:
+                try:
+                    segment = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                what = "Segment %d-%d of %s" % (segment[0], segment[1], os.path.basename(filename))
+                while segment[0] + segment[2] <= segment[1]:
+                    try:
+                        self._request("download", what, self._retrieve_segment, browser, url, partname, segment,
+                                      progress, mapname, lock, priority, hash_chunk)
+                    except (IOError, httplib.HTTPException) as e:
+                        with lock:
+                            errors.append(e)
+                        return
+
+        done = sum(segment[2] for segment in progress["segments"])
+        began = time.time()
+        with self.metrics.timer("download", file=os.path.basename(filename), segments=connections) as fields:
+            with self._transfer(priority):
+                if connections:
+                    run_threads(worker, connections)
+            if errors:
+                raise errors[0]
+            os.remove(mapname)
+            # Nothing is left to hash unless the part file was complete already
+            with self.metrics.timer("hash", file=os.path.basename(filename)):
+                digest.catch_up(partname, progress["size"])
+            self._complete(partname, filename, digest, checksum)
+            self._download_stats(fields, sum(segment[2] for segment in progress["segments"]) - done, began)
+        return filename
+
+    def _probe_size(self, url, browser):
+        """Size of the file at url, or None if the server doesn't honor Range"""
+        request = self._new_request(url)
+        request.add_header("Range", "bytes=0-0")
+        response = browser.open_novisit(request)
+        response.close()
+        if response.code != 206:
+            return None
+        match = re.match(r"bytes 0-0/(\d+)$", response.info().getheader("Content-Range") or "")
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    @staticmethod
+    def _contiguous(progress):
+        """Number of bytes downloaded contiguously from the start of the file"""
+        end = 0
+        for start, last, received in progress["segments"]:
+            end = start + received
+            if end <= last:
+                break
+        return end
+
+    def _retrieve_segment(self, browser, url, partname, segment, progress, mapname, lock, priority, hash_chunk):
+        start, end = segment[0] + segment[2], segment[1]
+        request = self._new_request(url)
+        request.add_header("Range", "bytes=%d-%d" % (start, end))
+        response = browser.open_novisit(request)
+        try:
+            if response.code != 206:
+                raise IOError("Server ignored range request for segment %d-%d" % (start, end))
+            with open(partname, "r+b") as f:
+                f.seek(start)
+                while segment[0] + segment[2] <= end:
+                    chunk = self._read(response, min(self.CHUNK_SIZE, end + 1 - segment[0] - segment[2]), priority)
+                    if not chunk:
+                        raise socket.error("Connection closed at byte %d of segment %d-%d"
+                                           % (segment[0] + segment[2], segment[0], end))
+                    self._write(f, chunk)
+                    # Data must be on disk before the progress map claims it
+                    f.flush()
+                    # and in the hash before it can be read back for hashing
+                    hash_chunk(segment[0] + segment[2], chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        self._save_progress(mapname, progress)
+        finally:
+            response.close()
+
+    @staticmethod
+    def _save_progress(mapname, progress):
+        with open(mapname + ".tmp", "w") as f:
+            json.dump(progress, f)
+        os.rename(mapname + ".tmp", mapname)
+
+    def download_files(self, download_dir, jobs, workers=None, segments=1, priority=PRIORITY_CONTENT):
+        """Download a list of (url, filename) jobs concurrently
+
+        Transfers run on a bounded pool of worker threads. Each worker has its
+        own browser, but they all share this downloader's cookie jar, so one
+        login serves every transfer. With several accounts, each file is
+        downloaded by the least busy account it was listed to, see route().
+        With segments above 1, each file is fetched with retrieve_segmented().
+        Returns the filenames that were downloaded successfully.
+        """
+        if workers is None:
+            workers = self.DOWNLOAD_WORKERS
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        downloaded = []
+        lock = threading.Lock()
+
+        def worker():
+            browsers = {}
+            while True:
+                try:
+                    url, filename = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                logging.info("Downloading file: %s" % filename)
+                account, url = self.route(url)
+                if account not in browsers:
+                    browsers[account] = account.get_browser(self.debug)
+                try:
+                    if segments > 1:
+                        account.retrieve_segmented(url, os.path.join(download_dir, filename), segments,
+                                                   browsers[account], priority)
+                    else:
+                        account.retrieve(url, os.path.join(download_dir, filename), browsers[account], priority)
+                except REQUEST_ERRORS + (ChecksumError,) as e:
+                    logging.error("Unable to download %s: %s" % (filename, e))
+                    continue
+                finally:
+                    self._done(account)
+                logging.info("Finished downloading file: %s" % filename)
+                with lock:
+                    downloaded.append(filename)
+
+        run_threads(worker, min(workers, len(jobs)))
+        return downloaded
+
     def _save_cookies(self):
-        self.cj.save("cookies.txt", ignore_discard=True, ignore_expires=True)
+        self.session.save()
         
-    def get_all_releases(self):
+    def get_all_releases(self, use_cache=True):
         logging.info("Checking for available main releases:")
-        result = self._check_software()
-        needlogin = False
-        if result.find("<h1>Single Sign On</h1>") != -1:
-            needlogin = True
-            logging.debug("Got single sign on page")
-        elif result.find("<h4>You are not authorized to perform this action.</h4>") != -1:
-            needlogin = True
-            logging.debug("Got not authorized page")
-        elif result.find("An unexpected error has occurred.") != -1:
-            needlogin = True
-            logging.debug("Got unexpected error page")
-        if needlogin:
-            logging.info("Not logged in.")
-            self.login()
-            logging.info("Checking for new content updates (2nd attempt)")
-            result = self._check_software()
-        download_regex = "https://downloads.paloaltonetworks.com/software"
-        logging.info(download_regex)
-        try:
-            releases = list(self.browser.links(url_regex=download_regex))
-        except IndexError:
-            raise UpdateError("Unable to get content update list")
-        release_list = []
+        if len(self.accounts) > 1:
+            return self._merge_releases(lambda account: account._get_releases(use_cache))
+        return self._get_releases(use_cache)
+
+    def _get_releases(self, use_cache):
+        releases = self._get_listing(self.SOFTWARE_URL, lambda links: list(self._parse_releases(links)), use_cache)
         for release in releases:
-            link = release.url
-            text = release.text
+            self._published_checksum(release)
+        return releases
+
+    def iter_releases(self):
+        """Generate [text, link] of each software release
+
+        Unlike get_all_releases(), releases are yielded while the
+        SoftwareUpdates page is still being read, and the page cache is
+        not used. With several accounts, the pages of all of them are
+        read in parallel and merged before the first release is yielded.
+        """
+        logging.info("Checking for available main releases:")
+        if len(self.accounts) > 1:
+            for release in self._merge_releases(lambda account: list(account._iter_releases())):
+                yield release
+            return
+        for release in self._iter_releases():
+            yield release
+
+    def _iter_releases(self):
+        self.ensure_login()
+        response = self._request("listing", "Listing of %s" % self.SOFTWARE_URL, self._open_listing, self.SOFTWARE_URL)
+        for release in self._parse_releases(self._scan_listing(self.SOFTWARE_URL, response)):
+            self._published_checksum(release)
+            yield release
+
+    def _merge_releases(self, fetch):
+        """Releases listed to any of the accounts, fetched in parallel with fetch(account)
+
+        Each file is listed once, in the order the accounts list them, and
+        the accounts entitled to it are recorded for route(). An account
+        that fails to log in or list is left out, unless they all fail, and
+        recorded in self.failed_accounts: its releases are missing from the
+        listing, not gone.
+        """
+        listings = [None] * len(self.accounts)
+        errors = []
+        failed = []
+        queue = Queue.Queue()
+        for number, account in enumerate(self.accounts):
+            queue.put((number, account))
+
+        def worker():
+            number, account = queue.get_nowait()
+            try:
+                listings[number] = fetch(account)
+            except REQUEST_ERRORS as e:
+                logging.error("Unable to list releases of account %s: %s" % (account.username, e))
+                errors.append(e)
+                failed.append(account)
+
+        run_threads(worker, len(self.accounts))
+        if len(errors) == len(self.accounts):
+            raise errors[0]
+        releases = []
+        entitlements = {}
+        for account, listing in zip(self.accounts, listings):
+            for release in listing or ():
+                key = release[1].split("?")[0]
+                if key not in entitlements:
+                    entitlements[key] = []
+                    releases.append(release)
+                    self._published_checksum(release)
+                entitlements[key].append((account, release[1]))
+        self.entitlements = entitlements
+        self.failed_accounts = failed
+        logging.info("%d releases listed to %d accounts" % (len(releases), len(self.accounts) - len(errors)))
+        return releases
+
+    def route(self, url):
+        """(downloader, url) to download url with, counted as busy until _done()
+
+        Of the accounts the file was listed to, the one with the fewest
+        downloads in progress is used, with the link listed to it. Files
+        not listed to any account in this run are downloaded by this one.
+        """
+        candidates = self.entitlements.get(url.split("?")[0]) or [(self, url)]
+        with self._busy_lock:
+            account, url = min(candidates, key=lambda candidate: self._busy.get(candidate[0], 0))
+            self._busy[account] = self._busy.get(account, 0) + 1
+        return account, url
+
+    def _done(self, account):
+        with self._busy_lock:
+            self._busy[account] -= 1
+
+    def _parse_releases(self, links):
+        download_regex = re.compile(self.DOWNLOAD_URL + "software")
+        for link, text, checksum in links:
+            if download_regex.search(link) is None: continue
             if ".pdf" in text: continue # This is release notes, which we don't want.
-            else:
-                this_release = [text,link]
-                release_list.append(this_release)
-        return release_list
-
-    def _check_software(self):
-        self.browser.open(self.SOFTWARE_URL)
-        temp = self.browser.response().read()
-        logging.info(temp)
-        return temp
-
-    def download_software(self, download_dir,url):
-        os.chdir(download_dir)
+            yield [text, link, checksum]
+
+    @staticmethod
+    def software_filename(url):
+        """Filename of a software download link"""
         filename = url.split("/")
         filename = filename[len(filename)-1]
-        filename = filename.split("?")[0]
-        self.browser.retrieve(url,filename)
+        return filename.split("?")[0]
+
+    def download_software(self, download_dir, url, segments=None):
+        filename = self.software_filename(url)
+        account, url = self.route(url)
+        try:
+            account.retrieve_segmented(url, os.path.join(download_dir, filename), segments)
+        finally:
+            self._done(account)
         return filename
 
     
-def get_config(filename):
-    config = ConfigParser.SafeConfigParser({"filedir": ""})
+class Watcher(object):
+    """Keeps polling for new content updates and downloads them
+
+    Every package gets its own poll interval, adapted to how often new
+    versions of it were seen: POLL_FRACTION polls per average time between
+    releases, bounded by MIN_INTERVAL and MAX_INTERVAL. Failed polls back
+    off exponentially with random jitter. The state of every package (last
+    check, last download, recent release times, next check) is written to
+    statefile after each poll, so it survives restarts and can be looked at
+    while the watcher runs.
+    """
+
+    MIN_INTERVAL = 60
+    MAX_INTERVAL = 6 * 3600
+    # Interval used until the release cadence of a package is known
+    DEFAULT_INTERVAL = 900
+    MAX_BACKOFF = 3600
+    POLL_FRACTION = 4
+    # Number of release times remembered per package
+    HISTORY = 10
+
+    def __init__(self, downloader, packages, download_dir, statefile="watch_state.json", workers=None,
+                 retention=None):
+        self.downloader = downloader
+        self.retention = retention or {}
+        self.packages = packages
+        self.download_dir = download_dir
+        self.statefile = statefile
+        self.workers = workers
+        try:
+            with open(statefile) as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {}
+        for package in packages:
+            self.state.setdefault(package, {
+                "version": None,
+                "last_check": None,
+                "last_download": None,
+                "releases": [],
+                "failures": 0,
+                "interval": self.DEFAULT_INTERVAL,
+                "next_check": 0,
+            })
+
+    def run(self):
+        """Poll until interrupted"""
+        logging.info("Watching for new content updates: %s" % ", ".join(self.packages))
+        while True:
+            now = time.time()
+            due = [p for p in self.packages if self.state[p]["next_check"] <= now]
+            if due:
+                self.poll(due)
+            wakeup = min(self.state[p]["next_check"] for p in self.packages)
+            time.sleep(max(1, wakeup - time.time()))
+
+    def poll(self, packages):
+        """Check packages once, download new versions and reschedule"""
+        try:
+            updates = self.downloader.check_packages(packages)
+            jobs = self._jobs(packages, updates)
+            if jobs and self.downloader.listing_cached:
+                # Download links from the cache may have expired
+                updates = self.downloader.check_packages(packages, use_cache=False)
+                jobs = self._jobs(packages, updates)
+            downloaded = self.downloader.download_files(self.download_dir, jobs, self.workers) if jobs else []
+            prune(self.downloader.get_index(self.download_dir),
+                  dict((p, self.retention[p]) for p in packages if p in self.retention
+                       and ContentDownloader.get_prefix(p) + "-" + updates[p][0] in downloaded))
+        except REQUEST_ERRORS + (ChecksumError,) as e:
+            logging.error("Unable to check for content updates: %s" % e)
+            for package in packages:
+                self._failed(package)
+        else:
+            for package in packages:
+                self._checked(package, updates[package][0], downloaded)
+        self._save()
+        self.downloader.metrics.write_prometheus()
+
+    def _jobs(self, packages, updates):
+        index = self.downloader.get_index(self.download_dir)
+        index.reconcile()
+        jobs = []
+        for package in packages:
+            version, url = updates[package]
+            prefix = ContentDownloader.get_prefix(package)
+            if not index.has(prefix, version):
+                jobs.append((url, prefix + "-" + version))
+        return jobs
+
+    def _checked(self, package, version, downloaded):
+        state = self.state[package]
+        now = time.time()
+        state["last_check"] = now
+        state["failures"] = 0
+        if ContentDownloader.get_prefix(package) + "-" + version in downloaded:
+            state["last_download"] = now
+        if version != state["version"]:
+            if state["version"] is not None:
+                logging.info("New %s version: %s" % (package, version))
+                state["releases"] = (state["releases"] + [now])[-self.HISTORY:]
+            state["version"] = version
+        state["interval"] = self._interval(state["releases"])
+        # A little jitter keeps many watchers from polling in step
+        state["next_check"] = now + state["interval"] * random.uniform(0.9, 1.1)
+        logging.debug("Next %s check in %d seconds" % (package, state["next_check"] - now))
+
+    def _failed(self, package):
+        state = self.state[package]
+        state["failures"] += 1
+        backoff = min(self.MAX_BACKOFF, self.MIN_INTERVAL * 2 ** state["failures"])
+        state["next_check"] = time.time() + random.uniform(self.MIN_INTERVAL, max(self.MIN_INTERVAL, backoff))
+        logging.info("Retrying %s check in %d seconds" % (package, state["next_check"] - time.time()))
+
+    def _interval(self, releases):
+        if len(releases) < 2:
+            return self.DEFAULT_INTERVAL
+        gap = (releases[-1] - releases[0]) / (len(releases) - 1)
+        return max(self.MIN_INTERVAL, min(self.MAX_INTERVAL, gap / self.POLL_FRACTION))
+
+    def _save(self):
+        with open(self.statefile + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(self.statefile + ".tmp", self.statefile)
+
+
+class HubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the listing, manifest and files of a HubServer"""
+
+    protocol_version = "HTTP/1.1"
+    # Buffer the status line and headers, so small responses on a kept
+    # alive connection aren't delayed by Nagle's algorithm
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        logging.debug("Hub request from %s: %s" % (self.client_address[0], format % args))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        published = self.server.published()
+        if path == HubServer.LISTING_PATH:
+            base = "http://%s/" % self.headers.get("Host", "%s:%d" % self.server.server_address)
+            self._send_page(self.server.listing(published, base), "text/html; charset=utf-8")
+        elif path == HubServer.MANIFEST_PATH:
+            self._send_page(json.dumps(self.server.manifest(published), indent=1, sort_keys=True),
+                            "application/json")
+        else:
+            for package, url_path, filename, entry in published:
+                if url_path == path:
+                    return self._send_file(filename, entry)
+            self.send_error(404)
+
+    def _send_page(self, body, content_type):
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_file(self, filename, entry):
+        path = os.path.join(self.server.directory, filename)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return self.send_error(404)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range") or "")
+            if match is not None:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), end)
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end + 1 - start))
+            self.send_header("Accept-Ranges", "bytes")
+            if entry.get("sha256"):
+                self.send_header("ETag", '"%s"' % entry["sha256"])
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+            f.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                data = f.read(min(ContentDownloader.CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+class HubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Publishes the content packages of a download directory to peers
+
+    The packages in the directory's RepositoryIndex are listed at
+    LISTING_PATH in the format of the DynamicUpdates page, with their
+    checksums, and the files are served under the same paths as on the
+    download server. A peer that sets its hub to this server's URL
+    (ContentDownloader.use_hub) checks and downloads from it like it
+    would from the support portal, without logging in. The listing has an
+    ETag, so peers with a page cache revalidate it with a conditional GET.
+    A JSON manifest of every published version is served at MANIFEST_PATH.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    LISTING_PATH = "/Updates/DynamicUpdates"
+    MANIFEST_PATH = "/manifest.json"
+
+    def __init__(self, directory, address=("", 8080)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, HubHandler)
+        self.directory = directory
+        self._paths = dict((ContentDownloader.get_prefix(p), path) for p, path in ContentDownloader.PACKAGE.items())
+        self._index = RepositoryIndex(directory)
+        self._published = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server_address
+
+    def start(self):
+        """Serve in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def published(self):
+        """(package, url path, filename, index entry) of the published files, newest first
+
+        Downloads to the directory are recorded by other RepositoryIndex
+        instances, and every change to the index changes the directory's
+        mtime. So the index is only read again, and the list rebuilt,
+        when reconcile() finds the mtime changed. Otherwise a request only
+        costs a stat of the directory.
+        """
+        with self._lock:
+            if self._index.reconcile() or self._published is None:
+                self._published = self._publish(self._index.files)
+            return self._published
+
+    def _publish(self, files):
+        published = []
+        for filename, entry in files.items():
+            if entry["package"] not in self._paths:
+                continue
+            url_path = "/%s-%s" % (self._paths[entry["package"]], entry["version"])
+            published.append((entry["package"], url_path, filename, entry))
+        published.sort(key=lambda item: (item[0], version_key(item[3]["version"])), reverse=True)
+        return published
+
+    def listing(self, published, base):
+        rows = []
+        for package, url_path, filename, entry in published:
+            rows.append('<tr><td>%s</td><td><a href="%s%s?hub">Download</a></td><td>%s</td></tr>'
+                        % (filename, base.rstrip("/"), url_path, entry.get("sha256") or ""))
+        return "<html><body><table>\n%s\n</table></body></html>\n" % "\n".join(rows)
+
+    def manifest(self, published):
+        manifest = {}
+        for package, url_path, filename, entry in published:
+            manifest.setdefault(package, []).append({
+                "version": entry["version"],
+                "filename": filename,
+                "path": url_path,
+                "size": entry["size"],
+                "sha256": entry.get("sha256"),
+            })
+        return manifest
+
+
+class PushTarget(object):
+    """A firewall or Panorama that content packages are pushed to
+
+    packages is the list of packages pushed to it, or None for all of
+    them. With install, each package is installed after the upload. At
+    most concurrency packages are pushed to it at a time.
+    """
+
+    def __init__(self, name, url, key, packages=None, install=True, concurrency=1, verify=True):
+        self.name = name
+        parsed = urlparse.urlparse(url if "://" in url else "https://" + url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.path = parsed.path.rstrip("/") + "/api/"
+        self.key = key
+        self.packages = packages
+        self.install = install
+        self.concurrency = concurrency
+        self.verify = verify
+
+    def wants(self, package):
+        return self.packages is None or package in self.packages
+
+    def connection(self, timeout):
+        if self.scheme == "https":
+            # Firewalls often have self-signed management certificates
+            context = None if self.verify else ssl._create_unverified_context()
+            return httplib.HTTPSConnection(self.netloc, timeout=timeout, context=context)
+        return httplib.HTTPConnection(self.netloc, timeout=timeout)
+
+
+PushResult = collections.namedtuple("PushResult", "target filename status message seconds")
+
+
+class PushPipeline(object):
+    """Pushes downloaded content packages to firewalls and Panoramas
+
+    Files handed to submit() are uploaded with the PAN-OS XML API import
+    call to every target that takes their package, and installed there
+    if the target says so, while the run goes on downloading. Every
+    target has its own queue, worked by as many threads as its
+    concurrency, and at most workers uploads run at once overall. The
+    file is streamed from disk, never read into memory as a whole.
+
+    The result of every push is logged, timed in the metrics as the
+    "push" phase and kept in results until wait() returns it. wait()
+    waits for the queued pushes. Nothing waits with --watch, so only the
+    last RESULTS_KEPT results are kept.
+    """
+
+    # XML API import category of each package
+    CATEGORIES = {
+        "appthreat": "content",
+        "app":       "content",
+        "antivirus": "anti-virus",
+        "wildfire":  "wildfire",
+        "wildfire2": "wildfire",
+    }
+    CHUNK_SIZE = 1024 * 1024
+    # Timeout of a single API request
+    TIMEOUT = 300
+    # How long and how often an install job is followed
+    JOB_TIMEOUT = 1800
+    JOB_POLL_INTERVAL = 5
+    RESULTS_KEPT = 1000
+
+    def __init__(self, targets, workers=8, metrics=None):
+        self.targets = targets
+        self.metrics = metrics or Metrics()
+        self.results = collections.deque(maxlen=self.RESULTS_KEPT)
+        self._slots = threading.BoundedSemaphore(workers)
+        self._queues = dict((target.name, Queue.Queue()) for target in targets)
+        self._pending = 0
+        self._done = threading.Condition()
+        self._started = False
+
+    def submit(self, filename):
+        """Queue filename for the targets of its package. Returns the number of pushes queued"""
+        prefix, version = parse_package_filename(os.path.basename(filename))
+        packages = [p for p in ContentDownloader.PACKAGE if ContentDownloader.get_prefix(p) == prefix]
+        if not packages:
+            return 0
+        targets = [target for target in self.targets if target.wants(packages[0])]
+        with self._done:
+            self._pending += len(targets)
+            if not self._started:
+                self._start()
+        for target in targets:
+            logging.info("Pushing %s to %s" % (os.path.basename(filename), target.name))
+            self._queues[target.name].put((filename, packages[0]))
+        return len(targets)
+
+    def wait(self):
+        """Wait until every queued push is done, and return the results since the last wait()"""
+        with self._done:
+            while self._pending:
+                # With a timeout, so the wait can be interrupted
+                self._done.wait(1)
+            results = list(self.results)
+            self.results.clear()
+            return results
+
+    def _start(self):
+        for target in self.targets:
+            for _ in range(max(1, target.concurrency)):
+                thread = threading.Thread(target=self._worker, args=(target,))
+                thread.daemon = True
+                thread.start()
+        self._started = True
+
+    def _worker(self, target):
+        queue = self._queues[target.name]
+        while True:
+            filename, package = queue.get()
+            try:
+                with self._slots:
+                    self._push(target, filename, package)
+            finally:
+                with self._done:
+                    self._pending -= 1
+                    self._done.notify_all()
+
+    def _push(self, target, filename, package):
+        name = os.path.basename(filename)
+        category = self.CATEGORIES[package]
+        status, message = "failed", ""
+        began = time.time()
+        with self.metrics.timer("push", target=target.name, file=name) as fields:
+            try:
+                self._import(target, filename, category)
+                status = "imported"
+                if target.install:
+                    message = self._install(target, name, category)
+                    status = "installed"
+            except (IOError, httplib.HTTPException, PushError) as e:
+                message = str(e)
+            fields["result"] = status
+        result = PushResult(target.name, name, status, message, time.time() - began)
+        with self._done:
+            self.results.append(result)
+        if status == "failed":
+            self.metrics.count("push_failures")
+            logging.error("Unable to push %s to %s: %s" % (name, target.name, message))
+        else:
+            self.metrics.count("pushes")
+            logging.info("Pushed %s to %s: %s in %.1f seconds" % (name, target.name, status, result.seconds))
+        return result
+
+    def _import(self, target, filename, category):
+        """Upload filename with a streamed multipart/form-data import request"""
+        boundary = "content-downloader-%x" % random.getrandbits(64)
+        head = ('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n' % (boundary, os.path.basename(filename)))
+        tail = "\r\n--%s--\r\n" % boundary
+        connection = target.connection(self.TIMEOUT)
+        try:
+            connection.putrequest("POST", target.path + "?" + urllib.urlencode({"type": "import", "category": category}))
+            connection.putheader("X-PAN-KEY", target.key)
+            connection.putheader("Content-Type", "multipart/form-data; boundary=%s" % boundary)
+            connection.putheader("Content-Length", str(len(head) + os.path.getsize(filename) + len(tail)))
+            connection.endheaders()
+            connection.send(head)
+            with open(filename, "rb") as f:
+                while True:
+                    chunk = f.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    connection.send(chunk)
+            connection.send(tail)
+            return self._result(connection.getresponse())
+        finally:
+            connection.close()
+
+    def _install(self, target, name, category):
+        """Install an imported file and follow the install job until it is done"""
+        result = self._op(target, "<request><%s><upgrade><install><file>%s</file></install></upgrade></%s></request>"
+                          % (category, name, category))
+        job = result.findtext(".//job")
+        if not job:
+            return "".join(result.itertext()).strip()
+        deadline = time.time() + self.JOB_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(self.JOB_POLL_INTERVAL)
+            status = self._op(target, "<show><jobs><id>%s</id></jobs></show>" % job).find(".//job")
+            if status is not None and status.findtext("status") == "FIN":
+                lines = status.find("details")
+                details = " ".join(line.strip() for line in lines.itertext() if line.strip()) if lines is not None else ""
+                if status.findtext("result") != "OK":
+                    raise PushError("Install job %s failed: %s" % (job, details))
+                return "job %s: %s" % (job, details) if details else "job %s" % job
+        raise PushError("Install job %s not finished after %d seconds" % (job, self.JOB_TIMEOUT))
+
+    def _op(self, target, command):
+        connection = target.connection(self.TIMEOUT)
+        try:
+            connection.request("GET", target.path + "?" + urllib.urlencode({"type": "op", "cmd": command}),
+                               headers={"X-PAN-KEY": target.key})
+            return self._result(connection.getresponse())
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _result(response):
+        """The result element of an XML API response, or PushError if the call failed"""
+        # Imported here as no other part of a run needs it
+        from xml.etree import cElementTree as ElementTree
+        body = response.read()
+        try:
+            root = ElementTree.fromstring(body)
+        except SyntaxError:
+            raise PushError("HTTP %d %s: %s" % (response.status, response.reason, body[:200]))
+        if root.get("status") != "success":
+            raise PushError(" ".join(text.strip() for text in root.itertext() if text.strip())
+                            or "HTTP %d %s" % (response.status, response.reason))
+        return root.find("result") if root.find("result") is not None else root
+
+
+def load_config(filename):
+    """Parser of the config file, read once per run and given to the get_* functions"""
+    config = ConfigParser.SafeConfigParser({
+        "filedir": "",
+        "cachefile": "listing_cache.json",
+        "cache_ttl": "0",
+        "rate_limit": "",
+        "rate_burst": "",
+        "rate_file": "",
+        "backend": "mechanize",
+        "hub": "",
+        "metrics_file": "",
+        "prometheus_file": "",
+        "store": "",
+        "store_links": "hard",
+        "push_workers": "8",
+        "change_feed": "",
+    })
     config.read(filename)
+    return config
+
+
+def get_config(config):
     username = config.get('config', 'username')
     password = config.get('config', 'password')
     download_dir = config.get('config', 'filedir')
@@ -245,15 +2920,152 @@ def get_config(filename):
     return username, password, download_dir
 
 
+def get_accounts(config):
+    """(username, password) of the other support accounts in the config file
+
+    Each has an [account <name>] section with its username and password.
+    """
+    accounts = []
+    for section in sorted(config.sections()):
+        if section.startswith("account "):
+            accounts.append((config.get(section, 'username'), config.get(section, 'password')))
+    return accounts
+
+
+def get_page_cache(config):
+    """PageCache configured in the config file, or None if disabled"""
+    cachefile = config.get('config', 'cachefile')
+    if cachefile == "":
+        return None
+    return PageCache(cachefile, config.getint('config', 'cache_ttl'))
+
+
+def get_throttle(config):
+    """TokenBucket for the rate_limit in the config file, or None if unlimited"""
+    rate_limit = config.get('config', 'rate_limit')
+    if rate_limit == "" or parse_size(rate_limit) == 0:
+        return None
+    rate_burst = config.get('config', 'rate_burst')
+    return TokenBucket(parse_size(rate_limit), parse_size(rate_burst) if rate_burst else None,
+                       config.get('config', 'rate_file') or None)
+
+
+def get_backend(config):
+    """HTTP client backend named in the config file"""
+    backend = config.get('config', 'backend')
+    if backend not in ContentDownloader.BACKENDS:
+        raise ValueError("Unknown backend in the config file: %s" % backend)
+    return backend
+
+
+def get_hub(config):
+    """URL of the hub to get content updates from, or None for the portal"""
+    hub = config.get('config', 'hub')
+    return hub or None
+
+
+def get_metrics(config):
+    """Metrics writing to the events and Prometheus files in the config file"""
+    return Metrics(config.get('config', 'metrics_file') or None, config.get('config', 'prometheus_file') or None)
+
+
+def get_store(config):
+    """ContentStore configured in the config file, or None if not deduplicating"""
+    directory = config.get('config', 'store')
+    if directory == "":
+        return None
+    return ContentStore(directory, config.get('config', 'store_links'))
+
+
+def get_pipeline(config, metrics=None):
+    """PushPipeline to the targets in the push sections of the config file, or None if there are none
+
+    Each [push <name>] section names a firewall or Panorama with its url
+    and API key, and optionally the packages to push to it, whether to
+    install them, the number of concurrent pushes to it and whether to
+    verify its TLS certificate.
+    """
+    targets = []
+    for section in sorted(config.sections()):
+        if not section.startswith("push "):
+            continue
+        options = dict(config.items(section, raw=True))
+        packages = None
+        if options.get("packages", "all").strip() != "all":
+            packages = parse_packages(options["packages"])
+        targets.append(PushTarget(section[5:].strip(), options["url"], options["api_key"], packages,
+                                  config.getboolean(section, "install") if "install" in options else True,
+                                  int(options.get("concurrency", 1)),
+                                  config.getboolean(section, "verify_tls") if "verify_tls" in options else True))
+    if not targets:
+        return None
+    return PushPipeline(targets, config.getint('config', 'push_workers'), metrics)
+
+
+def get_change_feed(config):
+    """ChangeFeed configured in the config file, or None if disabled"""
+    change_feed = config.get('config', 'change_feed')
+    if change_feed == "":
+        return None
+    return ChangeFeed(change_feed)
+
+
+def get_retention(config):
+    """RetentionPolicy of each package, from the retention sections of the config file
+
+    The [retention] section applies to every package, and a
+    [retention <package>] section overrides it for one package.
+    """
+    policies = {}
+    for package in ContentDownloader.PACKAGE:
+        policy = RetentionPolicy()
+        for section in ("retention", "retention " + package):
+            if config.has_section(section):
+                policy.configure(dict(config.items(section, raw=True)))
+        policies[package] = policy
+    return policies
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Download the latest Palo Alto Networks dynamic content update')
     parser.add_argument('-v', '--verbose', action='count', help="Verbose (-vv for extra verbose)")
     parser.add_argument('-p', '--package', help="Options: appthreat, app, antivirus, wildfire (for PAN-OS 7.0 and"
                                                 " lower), or wildfire2 (for PAN-OS 7.1 and higher). If ommited, "
                                                 "defaults to 'appthreat'.")
+    parser.add_argument('--packages', help="Comma separated list of packages to check and download in one run, "
+                                           "or 'all' for every package. Overrides -p.")
+    parser.add_argument('-w', '--workers', type=int, default=ContentDownloader.DOWNLOAD_WORKERS,
+                        help="Number of concurrent downloads when using --packages (default %d)"
+                             % ContentDownloader.DOWNLOAD_WORKERS)
+    parser.add_argument('--verify', action='store_true', help="Check the files in the download directory against "
+                                                              "their recorded checksums and exit")
+    parser.add_argument('--prune', action='store_true', help="Delete old versions of the packages according to "
+                                                             "the retention settings and exit")
+    parser.add_argument('--dry-run', action='store_true', help="With --prune, only report what would be deleted")
+    parser.add_argument('--watch', action='store_true', help="Keep running and download new versions as they are "
+                                                             "released, instead of checking once")
+    parser.add_argument('--state-file', default="watch_state.json",
+                        help="File where --watch keeps the state of each package (default watch_state.json)")
+    parser.add_argument('--serve', metavar="[HOST:]PORT",
+                        help="Run as a hub: watch for new versions like --watch and serve the download directory "
+                             "to peers over HTTP")
+    parser.add_argument('--check', action='store_true',
+                        help="Only check for new versions of the package (or --packages) without downloading: "
+                             "print them and exit with status 1 if there are any, 0 if not")
     return parser.parse_args()
 
 
+def parse_packages(packages):
+    """Turn the --packages argument into a sorted list of package names"""
+    if packages.strip() == "all":
+        return sorted(ContentDownloader.PACKAGE)
+    packages = [p.strip() for p in packages.split(",") if p.strip()]
+    for package in packages:
+        if package not in ContentDownloader.PACKAGE:
+            raise UnknownPackage("Unknown package type: %s" % package)
+    return packages
+
+
 def enable_logging(options):
     # Logging
     if options.verbose is not None:
@@ -274,36 +3086,208 @@ def main():
     debugenabled = enable_logging(options)
 
     # Config file (for support account credentials)
-    username, password, download_dir = get_config('content_downloader.conf')
+    config = load_config('content_downloader.conf')
+    username, password, download_dir = get_config(config)
+    # Bandwidth limit shared by all downloads
+    ContentDownloader.throttle = get_throttle(config)
+    ContentDownloader.metrics = get_metrics(config)
+    ContentDownloader.store = get_store(config)
+    # Downloaded content packages are pushed to the firewalls while the run goes on
+    ContentDownloader.pipeline = get_pipeline(config, ContentDownloader.metrics)
+    ContentDownloader.feed = get_change_feed(config)
+    atexit.register(ContentDownloader.metrics.write_prometheus)
+    # Peers of a hub get their content updates from it
+    hub = get_hub(config)
+    if hub is not None:
+        ContentDownloader.use_hub(hub)
+
+    if options.verify:
+        failed = verify_directory(download_dir, options.workers)
+        for filename in failed:
+            print("Failed verification: %s" % filename)
+        sys.exit(1 if failed else 0)
+
+    if options.prune:
+        packages = parse_packages(options.packages) if options.packages is not None else sorted(ContentDownloader.PACKAGE)
+        policies = get_retention(config)
+        pruned = prune(RepositoryIndex(download_dir), dict((p, policies[p]) for p in packages), options.dry_run)
+        for filename in pruned:
+            print("%s %s" % ("Would delete" if options.dry_run else "Deleted", filename))
+        sys.exit(0)
+
+    if options.check:
+        sys.exit(check_only(options, config, username, password, download_dir, debugenabled))
+
+    if options.serve:
+        sys.exit(serve(options, config, username, password, download_dir, debugenabled))
+
+    if options.watch:
+        sys.exit(watch(options, config, username, password, download_dir, debugenabled))
+
+    if options.packages is not None:
+        sys.exit(download_packages(options, config, username, password, download_dir, debugenabled))
 
     # Create contentdownloader object
-    content_downloader = ContentDownloader(username=username, password=password, package=options.package, debug=debugenabled)
+    content_downloader = ContentDownloader(username=username, password=password, package=options.package,
+                                           debug=debugenabled, cache=get_page_cache(config),
+                                           backend=get_backend(config))
 
     # Check latest version. Login if necessary.
     latestversion, fileurl = content_downloader.check()
 
-    # Get previously downloaded versions from download directory
-    downloaded_versions = []
-    for f in os.listdir(download_dir):
-        match = re.match(content_downloader.prefix + "-([\d-]*)$", f)
-        if match is not None:
-            downloaded_versions.append(match.group(1))
+    # Get previously downloaded versions from the download directory index
+    index = content_downloader.get_index(download_dir)
+    index.reconcile()
 
     # Check if already downloaded latest and do nothing
-    if latestversion in downloaded_versions:
+    if index.has(content_downloader.prefix, latestversion):
         logging.info("Already downloaded latest version: %s" % latestversion)
         sys.exit(0)
 
+    # Download links from the cache may have expired, get fresh ones
+    if content_downloader.listing_cached:
+        content_downloader.check(use_cache=False)
+
     # Download latest version to download directory
     logging.info("Downloading latest version: %s" % latestversion)
     filename = content_downloader.download(download_dir)
     if filename is not None:
         logging.info("Finished downloading file: %s" % filename)
+        policy = get_retention(config)[content_downloader.package]
+        prune(index, {content_downloader.package: policy})
+        if not finish_pushes():
+            sys.exit(1)
     else:
         logging.error("Unable to download latest content update")
 
 
+def check_only(options, config, username, password, download_dir, debugenabled):
+    """Print the packages with a new version that isn't downloaded yet
+
+    The listing is taken from the cache or revalidated with a conditional
+    request, and compared with the download directory index. Any request is
+    made with the pooled backend, which is much quicker to set up than
+    mechanize. Returns the exit code for the program: 1 if there are new
+    versions, else 0.
+    """
+    if options.packages is not None:
+        packages = parse_packages(options.packages)
+    else:
+        packages = [options.package or "appthreat"]
+    content_downloader = ContentDownloader(username=username, password=password, package=packages[0],
+                                           debug=debugenabled, cache=get_page_cache(config),
+                                           backend="pooled")
+    updates = content_downloader.check_packages(packages)
+    index = content_downloader.get_index(download_dir)
+    index.reconcile()
+    new = 0
+    for package in packages:
+        latestversion = updates[package][0]
+        if index.has(ContentDownloader.get_prefix(package), latestversion):
+            logging.info("Already downloaded latest %s version: %s" % (package, latestversion))
+            continue
+        print("New %s version: %s" % (package, latestversion))
+        new += 1
+    return 1 if new else 0
+
+
+def download_packages(options, config, username, password, download_dir, debugenabled):
+    """Check and download several packages with a single login
+
+    Returns the exit code for the program.
+    """
+    packages = parse_packages(options.packages)
+    content_downloader = ContentDownloader(username=username, password=password, package=packages[0],
+                                           debug=debugenabled, cache=get_page_cache(config),
+                                           backend=get_backend(config))
+
+    # Check latest version of every package from one DynamicUpdates page
+    updates = content_downloader.check_packages(packages)
+
+    index = content_downloader.get_index(download_dir)
+    index.reconcile()
+    missing = []
+    for package in packages:
+        latestversion, fileurl = updates[package]
+        if index.has(ContentDownloader.get_prefix(package), latestversion):
+            logging.info("Already downloaded latest %s version: %s" % (package, latestversion))
+            continue
+        logging.info("Latest %s version to download: %s" % (package, latestversion))
+        missing.append(package)
+
+    if not missing:
+        return 0
+    # Download links from the cache may have expired, get fresh ones
+    if content_downloader.listing_cached:
+        updates = content_downloader.check_packages(missing, use_cache=False)
+    jobs = []
+    for package in missing:
+        latestversion, fileurl = updates[package]
+        jobs.append((fileurl, ContentDownloader.get_prefix(package) + "-" + latestversion))
+    downloaded = content_downloader.download_files(download_dir, jobs, options.workers)
+    policies = get_retention(config)
+    prune(index, dict((p, policies[p]) for p in missing
+                      if ContentDownloader.get_prefix(p) + "-" + updates[p][0] in downloaded))
+    pushed = finish_pushes()
+    if len(downloaded) != len(jobs):
+        logging.error("Unable to download %d of %d content updates" % (len(jobs) - len(downloaded), len(jobs)))
+        return 1
+    return 0 if pushed else 1
+
+
+def finish_pushes():
+    """Wait for the pushes of the downloaded files and print their results
+
+    Returns False if any of them failed.
+    """
+    if ContentDownloader.pipeline is None:
+        return True
+    results = ContentDownloader.pipeline.wait()
+    for result in results:
+        print("%-10s %s to %s (%.1fs)%s" % (result.status, result.filename, result.target, result.seconds,
+                                           ": " + result.message if result.message else ""))
+    return all(result.status != "failed" for result in results)
+
+
+def watch(options, config, username, password, download_dir, debugenabled):
+    """Run the watcher until interrupted. Returns the exit code for the program"""
+    if options.packages is not None:
+        packages = parse_packages(options.packages)
+    else:
+        packages = [options.package or "appthreat"]
+    cache = get_page_cache(config)
+    if cache is not None:
+        # The watcher does its own scheduling, always revalidate the listing
+        cache.ttl = 0
+    content_downloader = ContentDownloader(username=username, password=password, package=packages[0],
+                                           debug=debugenabled, cache=cache,
+                                           backend=get_backend(config))
+    watcher = Watcher(content_downloader, packages, download_dir, options.state_file, options.workers,
+                      get_retention(config))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")
+    return 0
+
+
+def serve(options, config, username, password, download_dir, debugenabled):
+    """Run a hub until interrupted. Returns the exit code for the program"""
+    host, _, port = options.serve.rpartition(":")
+    hub = HubServer(download_dir, (host, int(port))).start()
+    logging.info("Serving %s to peers at %s" % (download_dir, hub.url))
+    try:
+        return watch(options, config, username, password, download_dir, debugenabled)
+    finally:
+        hub.shutdown()
+
+
 # Call the main() function to begin the program if not
 # loaded as a module.
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except REQUEST_ERRORS + (ChecksumError,) as e:
+        # Transient failures have been retried already
+        logging.error("%s" % e)
+        sys.exit(1)
@@ -1,335 +1,678 @@
-#!/usr/bin/env python
-
-#Copyright (c) 2016 Data Equipment AS
-#Author: Tor Mogstad <torm _AT_ dataequipment.no>
-
-#Permission is hereby granted, free of charge, to any person obtaining a copy
-#of this software and associated documentation files (the "Software"), to deal
-#in the Software without restriction, including without limitation the rights
-#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-#copies of the Software, and to permit persons to whom the Software is
-#furnished to do so, subject to the following conditions:
-
-#The above copyright notice and this permission notice shall be included in all
-#copies or substantial portions of the Software.
-
-#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-#SOFTWARE.
-
-
-
-
-"""Text menu based script for downloading software updates from
-support.paloaltonetworks.com
-"""
-
-from contentdownloader import LoginError
-from contentdownloader import UpdateError
-from contentdownloader import UnknownPackage
-from contentdownloader import ContentDownloader
-import sys
-import os
-import re
-import json
-from os import path
-import argparse
-import logging
-import traceback
-import ConfigParser
-
-
-##### Static variables used in script - change only if needed
-CONFIG_FILE = "config.conf"  # Config file
-DATA_CACHE_FILE = "pan_releases_cache.json"
-LOG_FILE = "log.txt"  # Log file used by script
-# Supported loglevels
-LOGLEVELS = {
-		"DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"
-}
-
-# Readable list
-READABLE_FORMAT = {
-	"PanOS_200": "PAN-OS for PA-200",
-	"PanOS_500": "PAN-OS for PA-500",
-	"PanOS_2000": "PAN-OS for PA-2000",
-	"PanOS_3000": "PAN-OS for PA-3000",
-	"PanOS_5000": "PAN-OS for PA-5000",
-	"PanOS_7000": "PAN-OS for PA-7000",
-	"PA-VM-ESX": "PAN-OS for VM-Series Base Image",
-	"Phoenix": "PAN-OS for VM-Series Base Image",
-	"PA-VM": "PAN-OS for VM-Series Base Image",
-	"PanOS_vm": "PAN-OS for VM-Series",
-	"PanCMS_pc": "PAN-OS for VM-Series",
-	"PA-VM-NSX": "PAN-OS for VM-Series NSX Base Images",
-	"PA-VM-SDX": "PAN-OS for VM-Series SDX Base Images",
-	"PA-VM-KVM": "PAN-OS for VM-Series KVM Base Images",
-	"PA-VM-HPV": "PAN-OS for VM-Series Hyper-V Base Images",
-	"PanGP": "GlobalProtect Agent Bundle",
-	"PanVPN": "NetConnect Agent Bundle",
-	"Panorama_pc": "Panorama Updates",
-	"Panorama-ESX": "Panorama Base Images",
-	"Panorama-Server": "Panorama Base Images",
-	"Panorama_m": "Panorama M Images",
-	"WildFire_m": "WF-500 Appliance Updates",
-	"ESMCore_x64": "Endpoint Security Manager - Core",
-	"ESMConsole_x64": "Endpoint Security Manager - Console",
-	"ClientUpgradePackage": "Endpoint Protection for workstations - Upgrade packages",
-	"Traps_x64": "Endpoint Protection for workstations - x64",
-	"Traps_x86": "Endpoint Protection for workstations - x86",
-	"TrapsVDITool_x64": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x64",
-	"TrapsVDITool_x86": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x86",
-	"TrapsVDIToolx64": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x64",
-	"TrapsVDIToolx86": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x86",
-	"Traps_VDI_x64": "Endpoint Protection for virtual desktop infrastructure VDI - x64",
-	"Traps_VDI_x86": "Endpoint Protection for virtual desktop infrastructure VDI - x86",
-	"Traps_Server_x64": "Endpoint Protection for servers - x64",
-	"Traps_Server_x86": "Endpoint Protection for servers - x86",
-	"Traps_server_x64": "Endpoint Protection for servers - x64",
-	"Traps_server_x86": "Endpoint Protection for servers - x86",
-	"UaInstall": "User ID Agent",
-	"PanAgent": "User ID Agent",
-	"LaInstall": "User ID LDAP Agent",
-	"TaInstall64.x64": "Terminal Service Agent - x64",
-	"TaInstall64": "Terminal Service Agent - x64",
-	"TaInstall": "Terminal Service Agent - Win32",
-	"TaInstall32": "Terminal Service Agent - Win32",
-	"GlobalProtect": "Global Protect Agent - Win32",
-	"GlobalProtect64": "Global Protect Agent - x64",
-	}
-
-
-def get_passed_arguments():
-    parser = argparse.ArgumentParser(description='''Text menu based script for download updates from support.paloaltonetworks.com.
-	 								config.conf file must exist in directory and have a valid username and password in it.
-									''')
-    parser.add_argument('-l', '--loglevel', help="Set loglevel. Options: DEBUG, INFO, WARNING, ERROR or CRITICAL. Defaults to INFO")
-    return parser.parse_args()
-
-def start_logging(args="loglevel"):
-	global loglevel  # Need to change global loglevel variable
-	# Setting log level and logfile
-	if args is None:
-		loglevel = "DEBUG"  # Default is INFO
-	else:
-		loglevel = args
-	# If invalid loglevel passed by user.. exit..
-	if loglevel not in LOGLEVELS:
-		log_message = "Unknown loglevel type: %s" % args
-		print log_message
-		sys.exit()
-	# Set logging.basicConfig based on loglevel
-	try:
-		if loglevel == "DEBUG":
-			logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format='%(asctime)s - %(levelname)s -  %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-		elif loglevel == "INFO":
-			logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	        elif loglevel == "WARNING":
-        	        logging.basicConfig(filename=LOG_FILE, level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	        elif loglevel == "ERROR":
-        	        logging.basicConfig(filename=LOG_FILE, level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	        elif loglevel == "CRITICAL":
-        	        logging.basicConfig(filename=LOG_FILE, level=logging.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	except Exception as e:
-		print "ERROR setting logging level"
-		print(e)
-		sys.exit(0)
-	# Logging first message on script start
-	logging.info("Script started, and logging to file initialized")
-
-def get_config(filename):
-    config = ConfigParser.SafeConfigParser({"filedir": ""})
-    config.read(filename)
-    username = config.get('config', 'username')
-    password = config.get('config', 'password')
-    download_dir = config.get('config', 'filedir')
-    if download_dir == "":
-        download_dir = os.getcwd()
-    return username, password, download_dir
-
-def generate_release_list(releases):
-	complete_list = []
-	for release in releases:
-		version = release[0]
-		link = release[1]
-		if "WFWin" in version: continue #Skip these files
-		if "pkg" in version: continue #Skip these files
-		if "apk" in version: continue #Skip these files
-		if "generic" in version: continue #Skip thises txt files
-		try:
-			#Find Release name
-			name = re.sub(r'(-[0-9].*)', "", version) #Normal pan_os
-			name = re.sub(r'(_[0-9]\.[0-9]\.[0-9].*)', "", name) #Some traps and gp versions
-			name = re.sub(r'(_\.[0-9]\.[0-9]\.[0-9].*)', "", name) #other traps versions
-			if name[-1] == "_": name = name[:-1] #remove trailing _ from gp and traps
-
-			#Find release main version
-			complete_version = re.findall(r'([0-9]\..*)', version)[0]
-			main_version = "%s.%s" % (complete_version.split(".")[0], complete_version.split(".")[1])
-		except:
-			pass #link not what we are looking for, and can be ignored.
-			complete_version = "Error"
-			main_version = "Error main"
-			name = "Name Error"
-		#Find reable name - if defined
-		if name in READABLE_FORMAT:
-			readable_name = READABLE_FORMAT[name]
-		else:
-			readable_name = name
-		this_release = [name, main_version, complete_version, link, readable_name]
-		complete_list.append(this_release)
-
-	#Store list in file
-	with open(DATA_CACHE_FILE, 'wb') as outputfile:
-		json.dump(complete_list, outputfile)
-
-	return complete_list
-
-def build_main_menu(release_list):
-	quit_option = [0,"Quit"]
-	refresh_option = [1,"Refresh release information from download.paloaltonetworks.com"]
-	main_menu = [quit_option]
-	main_menu.append(refresh_option)
-	counter = 2
-	for release in release_list:
-		#check if item exists in menu_item
-		exists = False
-		for item in main_menu:
-			if release[4] == item[1]: exists = True
-		if not exists:
-			menu_item = [counter, release[4]]
-			main_menu.append(menu_item)
-			counter += 1
-	return main_menu
-
-def generate_sub_menu_1(release_list, selected_modell):
-	back_option = [0,"Back"]
-	quit_option = [1,"Quit"]
-	sub_menu_1 = [back_option]
-	sub_menu_1.append(quit_option)
-	counter = 2
-	for release in release_list:
-		#check if item has correct name
-		if release[4] == selected_modell:
-			#check if item exists in sub_menu_1
-			exists = False
-			for item in sub_menu_1:
-				if item[1] == release[1]: exists = True
-			if not exists:
-				this_item = [counter,release[1]]
-				sub_menu_1.append(this_item)
-				counter += 1
-	return sub_menu_1
-
-def generate_sub_menu_2(release_list, selected_main, selected_modell):
-	back_option = [0,"Back"]
-	quit_option = [1,"Quit"]
-	sub_menu_2 = [back_option]
-	sub_menu_2.append(quit_option)
-	counter = 2
-	for release in release_list:
-		#check if item has correct name
-		if release[4] == selected_modell:
-			if release[1] == selected_main:
-				#check if item exists in sub_menu_1
-				this_item = [counter,release[2],release[3]]
-				sub_menu_2.append(this_item)
-				counter += 1
-	return sub_menu_2
-
-def main():
-	# Get passed arguments
-	args = get_passed_arguments()
-	# Start logging
-	if args.loglevel:
-		if args.loglevel in LOGLEVELS: start_logging(args.loglevel)
-		else:
-			log_message = "Unsupported log leve set %s. Exiting...." % (args.loglevel)
-			logging.error(log_message)
-			if verbose: print log_message
-			sys.exit()
-	else: start_logging("INFO")  # INFO is default
-
-	#Parse config file
-	username, password, download_dir = get_config('config.conf')
-
-	#Create contentdownloader
-	if args.loglevel == "DEBUG": debugenabled = True
-	else: debugenabled = False
-	SwDownloader = ContentDownloader(username=username, password=password, debug=debugenabled)
-
-	#Try to open cache file
-	try:
-		with open(DATA_CACHE_FILE, 'r') as inputfile:
-			release_list = json.load(inputfile)
-		inputfile.close()
-		print "\nRelease information succesfully retrieved from cache..."
-	except: #Download content and generate new releash list if file doesn't exist
-		print "\nUnable read or find cache file. Retrieving release information from downloads.paloaltonetworks.com..please wait"
-		print "\nNB! account %s used to retrive files. You will only be able to download software accesible from this account." % (username)
-		releases = SwDownloader.get_all_releases()
-		release_list = generate_release_list(releases)
-
-	#Initial menu
-	while True:
-		# Generate main meny table
-		main_menu = build_main_menu(release_list)
-		#Print menu and catch user selection
-		print "\nDownload PAN-OS software from support.paloaltonetworks.com"
-		print "Please select which device to download software for:\n"
-		for option in main_menu:
-			print "%s - %s" %(option[0], option[1])
-		print ""
-		choice = input("Selection: ")
-		choice = int(choice)
-
-		if choice == 0: sys.exit() #Quit menu item
-		elif choice == 1: # Refresh menu item
-			print "\nRetrieving release information from downloads.paloaltonetworks.com..please wait"
-			print "NB! account %s used to retrive files. You will only be able to download software accesible from this account." % (username)
-			releases = SwDownloader.get_all_releases()
-			release_list = generate_release_list(releases)
-		elif choice > len(main_menu)-1: print "Incorrect selection..please try again.."
-		else:
-			#Sub menu 1
-			selected_modell = main_menu[choice][1]
-			#Generate submenu
-			sub_menu_1 = generate_sub_menu_1(release_list, selected_modell)
-			#print main_releases
-			while True:
-				print "\nSelect PAN-OS main release:\n"
-				for main_release in sub_menu_1:
-					print "%s - %s" % (main_release[0], main_release[1])
-				print ""
-				choice_main_version = input("Selection: ")
-				choice_main_version = int(choice_main_version)
-				if choice_main_version == 0: break
-				if choice_main_version == 1: sys.exit()
-				if choice_main_version > len(sub_menu_1)-1: print "Incorrect selection..please try again.."
-				else:
-					selected_main = sub_menu_1[choice_main_version][1]
-
-					#Generate submenu2
-					sub_menu_2 = generate_sub_menu_2(release_list, selected_main, selected_modell)
-					while True:
-						print "\nAvailable releases for main release %s. Please select to download:\n" % (selected_main)
-						for item in sub_menu_2:
-							print "%s - %s" % (item[0], item[1])
-						print ""
-						choice_patch_version = input("Selection: ")
-						choice_patch_version = int(choice_patch_version)
-						if choice_patch_version == 0: break
-						if choice_patch_version == 1: sys.exit()
-						if choice_patch_version > len(sub_menu_2)-1: print "Incorrect selection..please try again.."
-						else:
-							download_release = sub_menu_2[choice_patch_version]
-							print "\nDownloading %s for %s from %s....." % (download_release[1], selected_modell, download_release[2])
-							SwDownloader.download_software(download_dir,download_release[2])
-							print "\n%s has been downloaded to folder %s\n" % (download_release[1],download_dir)
-
-if __name__ == '__main__':
-	main()
+#!/usr/bin/env python
+
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+
+
+"""Text menu based script for downloading software updates from
+support.paloaltonetworks.com
+"""
+
+from content_downloader import LoginError
+from content_downloader import UpdateError
+from content_downloader import UnknownPackage
+from content_downloader import ChecksumError
+from content_downloader import ContentDownloader
+from content_downloader import ChangeFeed
+from content_downloader import REQUEST_ERRORS
+from content_downloader import load_config
+from content_downloader import get_config
+from content_downloader import get_throttle
+from content_downloader import get_backend
+from content_downloader import get_metrics
+from content_downloader import get_store
+from content_downloader import get_accounts
+from content_downloader import version_key as number_key
+import sys
+import os
+import re
+import json
+import time
+import sqlite3
+import collections
+from os import path
+import argparse
+import logging
+import traceback
+import atexit
+
+
+##### Static variables used in script - change only if needed
+CONFIG_FILE = "config.conf"  # Config file
+DATA_CACHE_FILE = "pan_releases_cache.json"  # Old cache file, imported into catalog once
+CATALOG_FILE = "pan_releases.db"  # Release catalog
+CATALOG_MAX_AGE = 24 * 3600  # Refresh release catalog when older than this (seconds)
+CHANGE_FEED_FILE = "pan_releases_changes.jsonl"  # Releases added to and removed from the catalog
+LOG_FILE = "log.txt"  # Log file used by script
+# Supported loglevels
+LOGLEVELS = {
+		"DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"
+}
+
+# Readable list
+READABLE_FORMAT = {
+	"PanOS_200": "PAN-OS for PA-200",
+	"PanOS_500": "PAN-OS for PA-500",
+	"PanOS_2000": "PAN-OS for PA-2000",
+	"PanOS_3000": "PAN-OS for PA-3000",
+	"PanOS_5000": "PAN-OS for PA-5000",
+	"PanOS_7000": "PAN-OS for PA-7000",
+	"PA-VM-ESX": "PAN-OS for VM-Series Base Image",
+	"Phoenix": "PAN-OS for VM-Series Base Image",
+	"PA-VM": "PAN-OS for VM-Series Base Image",
+	"PanOS_vm": "PAN-OS for VM-Series",
+	"PanCMS_pc": "PAN-OS for VM-Series",
+	"PA-VM-NSX": "PAN-OS for VM-Series NSX Base Images",
+	"PA-VM-SDX": "PAN-OS for VM-Series SDX Base Images",
+	"PA-VM-KVM": "PAN-OS for VM-Series KVM Base Images",
+	"PA-VM-HPV": "PAN-OS for VM-Series Hyper-V Base Images",
+	"PanGP": "GlobalProtect Agent Bundle",
+	"PanVPN": "NetConnect Agent Bundle",
+	"Panorama_pc": "Panorama Updates",
+	"Panorama-ESX": "Panorama Base Images",
+	"Panorama-Server": "Panorama Base Images",
+	"Panorama_m": "Panorama M Images",
+	"WildFire_m": "WF-500 Appliance Updates",
+	"ESMCore_x64": "Endpoint Security Manager - Core",
+	"ESMConsole_x64": "Endpoint Security Manager - Console",
+	"ClientUpgradePackage": "Endpoint Protection for workstations - Upgrade packages",
+	"Traps_x64": "Endpoint Protection for workstations - x64",
+	"Traps_x86": "Endpoint Protection for workstations - x86",
+	"TrapsVDITool_x64": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x64",
+	"TrapsVDITool_x86": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x86",
+	"TrapsVDIToolx64": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x64",
+	"TrapsVDIToolx86": "Endpoint Protection for virtual desktop infrastructure VDI Tool - x86",
+	"Traps_VDI_x64": "Endpoint Protection for virtual desktop infrastructure VDI - x64",
+	"Traps_VDI_x86": "Endpoint Protection for virtual desktop infrastructure VDI - x86",
+	"Traps_Server_x64": "Endpoint Protection for servers - x64",
+	"Traps_Server_x86": "Endpoint Protection for servers - x86",
+	"Traps_server_x64": "Endpoint Protection for servers - x64",
+	"Traps_server_x86": "Endpoint Protection for servers - x86",
+	"UaInstall": "User ID Agent",
+	"PanAgent": "User ID Agent",
+	"LaInstall": "User ID LDAP Agent",
+	"TaInstall64.x64": "Terminal Service Agent - x64",
+	"TaInstall64": "Terminal Service Agent - x64",
+	"TaInstall": "Terminal Service Agent - Win32",
+	"TaInstall32": "Terminal Service Agent - Win32",
+	"GlobalProtect": "Global Protect Agent - Win32",
+	"GlobalProtect64": "Global Protect Agent - x64",
+	}
+
+
+def get_passed_arguments():
+    parser = argparse.ArgumentParser(description='''Text menu based script for download updates from support.paloaltonetworks.com.
+	 								config.conf file must exist in directory and have a valid username and password in it.
+									''')
+    parser.add_argument('-l', '--loglevel', help="Set loglevel. Options: DEBUG, INFO, WARNING, ERROR or CRITICAL. Defaults to INFO")
+    parser.add_argument('-s', '--select', action='append', help="Download releases matching a selector instead of "
+                                                                "using the menu, eg. 'family=PanOS_5000 major=8.0 latest=3'. "
+                                                                "Can be given several times.")
+    parser.add_argument('-m', '--manifest', help="Download releases matching the selectors in a file, one per line")
+    parser.add_argument('--sync', help="Download the newest release of the last main versions of these comma "
+                                       "separated families, eg. 'PanOS_5000,PA-VM-ESX', unless already downloaded. "
+                                       "Readable names select every family with that name.")
+    parser.add_argument('-k', '--majors', type=int, default=2,
+                        help="Number of main versions per family for --sync (default 2)")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="With --select, --manifest or --sync, only list the files that would be downloaded")
+    parser.add_argument('-w', '--workers', type=int, default=ContentDownloader.DOWNLOAD_WORKERS,
+                        help="Number of concurrent downloads for --select, --manifest and --sync (default %d)"
+                             % ContentDownloader.DOWNLOAD_WORKERS)
+    return parser.parse_args()
+
+def start_logging(args="loglevel"):
+	global loglevel  # Need to change global loglevel variable
+	# Setting log level and logfile
+	if args is None:
+		loglevel = "DEBUG"  # Default is INFO
+	else:
+		loglevel = args
+	# If invalid loglevel passed by user.. exit..
+	if loglevel not in LOGLEVELS:
+		log_message = "Unknown loglevel type: %s" % args
+		print log_message
+		sys.exit()
+	# Set logging.basicConfig based on loglevel
+	try:
+		if loglevel == "DEBUG":
+			logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format='%(asctime)s - %(levelname)s -  %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+		elif loglevel == "INFO":
+			logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+	        elif loglevel == "WARNING":
+        	        logging.basicConfig(filename=LOG_FILE, level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+	        elif loglevel == "ERROR":
+        	        logging.basicConfig(filename=LOG_FILE, level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+	        elif loglevel == "CRITICAL":
+        	        logging.basicConfig(filename=LOG_FILE, level=logging.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+	except Exception as e:
+		print "ERROR setting logging level"
+		print(e)
+		sys.exit(0)
+	# Logging first message on script start
+	logging.info("Script started, and logging to file initialized")
+
+# Release files generate_release_list() leaves out, by part of their name
+SKIPPED_RELEASES = ("WFWin", "pkg", "apk", "generic")
+# Kind of artifact of a release file, by extension
+ARTIFACT_TYPES = {
+	"": "image",
+	".ova": "vm-image",
+	".qcow2": "vm-image",
+	".vhd": "vm-image",
+	".vhdx": "vm-image",
+	".xva": "vm-image",
+	".zip": "archive",
+	".tgz": "archive",
+	".tar.gz": "archive",
+	".msi": "installer",
+	".exe": "installer",
+	".dmg": "installer",
+}
+
+SKIPPED_REGEX = re.compile("|".join(re.escape(part) for part in SKIPPED_RELEASES))
+EXTENSIONS = "|".join(re.escape(e) for e in sorted(ARTIFACT_TYPES, key=len, reverse=True) if e)
+# Family, then - or _ (or _.), then a version starting with major.minor,
+# then an optional known extension. Eg. PanOS_5000-8.0.1-h3,
+# PA-VM-ESX-8.0.1.ova, Traps_x64_3.4.1.msi
+RELEASE_REGEX = re.compile(r"""^(?P<family>.+?)(?:-|_\.?)
+	(?P<version>(?P<major>[0-9]+\.[0-9]+)(?:[._\-][0-9A-Za-z]+)*?)
+	(?P<extension>%s)?$""" % EXTENSIONS, re.VERBOSE)
+EXTENSION_REGEX = re.compile("(%s)$" % EXTENSIONS)
+
+Release = collections.namedtuple("Release", "family major version extension artifact key")
+
+def version_key(version):
+	"""Sort key for release versions, eg. 7.1.10 after 7.1.9. A file extension is ignored"""
+	return number_key(EXTENSION_REGEX.sub("", version))
+
+def parse_release_name(name):
+	"""Parse a release filename into a Release, or None if it can't be parsed
+
+	key is the version_key() of the version, to sort versions by.
+	"""
+	match = RELEASE_REGEX.match(name)
+	if match is None: return None
+	version = match.group("version")
+	extension = match.group("extension") or ""
+	return Release(match.group("family"), match.group("major"), version, extension, ARTIFACT_TYPES[extension],
+		version_key(version))
+
+def generate_release_list(releases, unparsed=None):
+	"""[name, main_version, complete_version, link, readable_name] of each release
+
+	releases are [text, link, ...] lists from the SoftwareUpdates page. The
+	complete version includes the file extension, if any. Releases whose
+	name can't be parsed are logged and left out, and appended to the
+	unparsed list if one is given.
+	"""
+	complete_list = []
+	missed = 0
+	skipped = SKIPPED_REGEX.search
+	for release in releases:
+		text = release[0]
+		link = release[1]
+		if skipped(text): continue
+		parsed = parse_release_name(text)
+		if parsed is None:
+			logging.debug("Unable to parse release name: %s" % text)
+			missed += 1
+			if unparsed is not None: unparsed.append([text, link])
+			continue
+		complete_list.append([parsed.family, parsed.major, parsed.version + parsed.extension, link,
+			READABLE_FORMAT.get(parsed.family, parsed.family)])
+	if missed: logging.warning("Unable to parse %d release names" % missed)
+	return complete_list
+
+def latest_in_trains(release_list):
+	"""Newest release of each family and main version, by (family, main_version)
+
+	Releases are ordered by version_key(), the key of parse_release_name().
+	"""
+	latest = {}
+	for release in release_list:
+		train = (release[0], release[1])
+		key = version_key(release[2])
+		if train not in latest or key > latest[train][0]:
+			latest[train] = (key, release)
+	return dict((train, release) for train, (key, release) in latest.items())
+
+
+class ReleaseCatalog(object):
+	"""Release information stored in an indexed SQLite database
+
+	Each release is a row of family, main version, complete version, link
+	and readable name, keyed by the link without its query string. The time
+	of the last refresh is kept, so a stale catalog can be detected, and a
+	refresh only inserts and deletes the releases that changed.
+	"""
+
+	def __init__(self, filename=CATALOG_FILE):
+		self.db = sqlite3.connect(filename)
+		with self.db:
+			self.db.execute("""CREATE TABLE IF NOT EXISTS releases (
+				key TEXT PRIMARY KEY, family TEXT, main TEXT, version TEXT,
+				link TEXT, readable TEXT, position INTEGER)""")
+			self.db.execute("CREATE INDEX IF NOT EXISTS releases_readable ON releases (readable, main, position)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS releases_family ON releases (family, main, version)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+	@staticmethod
+	def key(release):
+		return release[3].split("?")[0]
+
+	def fetched(self):
+		"""Time of the last refresh, or None if never refreshed"""
+		row = self.db.execute("SELECT value FROM meta WHERE name = 'fetched'").fetchone()
+		if row is None: return None
+		return float(row[0])
+
+	def is_stale(self, max_age=CATALOG_MAX_AGE):
+		fetched = self.fetched()
+		return fetched is None or time.time() - fetched > max_age
+
+	def update(self, release_list, fetched=None, partial=False):
+		"""Update catalog from a fresh release list. Returns (added, removed)
+
+		A partial list, missing the releases of an account that couldn't be
+		listed, can't tell which releases were added or removed, so it only
+		updates the links of the releases in the catalog. The catalog stays
+		as old as it was, so it is refreshed again.
+		"""
+		if fetched is None: fetched = time.time()
+		existing = {}
+		for row in self.db.execute("SELECT key, family, main, version, link, readable FROM releases"):
+			existing[row[0]] = list(row[1:])
+		added = []
+		changed = []
+		seen = set()
+		for position, release in enumerate(release_list):
+			key = self.key(release)
+			if key in seen: continue
+			seen.add(key)
+			if key in existing:
+				changed.append((release[0], release[1], release[2], release[3], release[4], position, key))
+			elif not partial:
+				added.append((key, release[0], release[1], release[2], release[3], release[4], position))
+		removed = [] if partial else [key for key in existing if key not in seen]
+		with self.db:
+			self.db.executemany("INSERT INTO releases VALUES (?, ?, ?, ?, ?, ?, ?)", added)
+			# Links carry a download token, so keep the newest one. The rest
+			# is updated too, in case the release name is parsed differently
+			self.db.executemany("""UPDATE releases SET family = ?, main = ?, version = ?, link = ?, readable = ?,
+				position = ? WHERE key = ?""", changed)
+			self.db.executemany("DELETE FROM releases WHERE key = ?", [(key,) for key in removed])
+			if not partial:
+				self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fetched', ?)", (repr(fetched),))
+		return [list(release[1:6]) for release in added], [existing[key] for key in removed]
+
+	def releases(self):
+		"""All releases as [name, main_version, complete_version, link, readable_name] lists"""
+		return [list(row) for row in self.db.execute(
+			"SELECT family, main, version, link, readable FROM releases ORDER BY position")]
+
+	def readable_names(self):
+		return [row[0] for row in self.db.execute(
+			"SELECT readable FROM releases GROUP BY readable ORDER BY MIN(position)")]
+
+	def main_versions(self, readable_name):
+		return [row[0] for row in self.db.execute(
+			"SELECT main FROM releases WHERE readable = ? GROUP BY main ORDER BY MIN(position)",
+			(readable_name,))]
+
+	def versions(self, readable_name, main_version):
+		return [list(row) for row in self.db.execute(
+			"SELECT version, link FROM releases WHERE readable = ? AND main = ? ORDER BY position",
+			(readable_name, main_version))]
+
+	def import_cache_file(self, filename=DATA_CACHE_FILE):
+		"""Import release list from the old JSON cache file, if there is one"""
+		try:
+			with open(filename, 'r') as inputfile:
+				release_list = json.load(inputfile)
+		except (IOError, ValueError):
+			return False
+		self.update(release_list, os.path.getmtime(filename))
+		os.remove(filename)
+		return True
+
+
+def refresh_catalog(downloader, catalog, feed_file=CHANGE_FEED_FILE):
+	with downloader.metrics.timer("catalog_refresh") as fields:
+		releases = downloader.iter_releases()
+		unparsed = []
+		release_list = generate_release_list(releases, unparsed)
+		# Without the releases of an account that couldn't be listed
+		partial = bool(downloader.failed_accounts)
+		# The first refresh fills the catalog, it doesn't change it
+		first = catalog.fetched() is None
+		added, removed = catalog.update(release_list, partial=partial)
+		fields["added"], fields["removed"], fields["unparsed"] = len(added), len(removed), len(unparsed)
+		fields["partial"] = partial
+	if partial:
+		logging.warning("Release catalog not refreshed, releases of %s could not be listed. Only links were updated"
+			% ", ".join(account.username for account in downloader.failed_accounts))
+	else:
+		logging.info("Release catalog refreshed: %d added, %d removed" % (len(added), len(removed)))
+	if not first and not partial and feed_file:
+		ChangeFeed(feed_file).append("software", release_changes(added, removed))
+	return added, removed
+
+def release_changes(added, removed):
+	"""Versions added and removed of each family, for the change feed
+
+	Each family has its readable name too. Families without changes are
+	left out.
+	"""
+	changes = {}
+	for kind, releases in (("added", added), ("removed", removed)):
+		for release in releases:
+			family = changes.setdefault(release[0], {"name": release[4], "added": [], "removed": []})
+			family[kind].append(release[2])
+	for family in changes.values():
+		family["added"].sort(key=version_key)
+		family["removed"].sort(key=version_key)
+	return changes
+
+def try_refresh_catalog(downloader, catalog):
+	"""refresh_catalog(), reporting a failure instead of raising it. Returns True if refreshed"""
+	try:
+		refresh_catalog(downloader, catalog)
+	except REQUEST_ERRORS as e:
+		logging.error("Unable to refresh release information: %s" % e)
+		print "ERROR: unable to refresh release information: %s" % e
+		return False
+	return True
+
+# Keys accepted in selectors. family, major and version take comma separated lists
+SELECTOR_KEYS = ("family", "major", "version", "latest")
+
+def parse_selector(selector):
+	"""Parse a selector like 'family=PanOS_5000 major=8.0 latest=3' into a dict"""
+	terms = {}
+	for term in selector.split():
+		if "=" not in term: raise ValueError("Invalid selector term: %s" % term)
+		key, value = term.split("=", 1)
+		if key not in SELECTOR_KEYS: raise ValueError("Unknown selector key: %s" % key)
+		if key == "latest":
+			if not value.isdigit(): raise ValueError("latest must be a number: %s" % value)
+			terms[key] = int(value)
+		else:
+			terms[key] = value.split(",")
+	return terms
+
+def read_manifest(filename):
+	"""Read selectors from a file. Empty lines and # comments are ignored"""
+	selectors = []
+	with open(filename, 'r') as inputfile:
+		for line in inputfile:
+			line = line.split("#")[0].strip()
+			if line: selectors.append(line)
+	return selectors
+
+def select_releases(release_list, selector):
+	"""Releases matching a parsed selector
+
+	latest=N keeps only the N newest matching versions of each family.
+	"""
+	matches = []
+	for release in release_list:
+		if "family" in selector and release[0] not in selector["family"]: continue
+		if "major" in selector and release[1] not in selector["major"]: continue
+		if "version" in selector and release[2] not in selector["version"]: continue
+		matches.append(release)
+	if "latest" in selector:
+		families = {}
+		for release in matches:
+			families.setdefault(release[0], []).append(release)
+		matches = []
+		for family in sorted(families):
+			newest = sorted(families[family], key=lambda release: version_key(release[2]), reverse=True)
+			matches.extend(newest[:selector["latest"]])
+	return matches
+
+def sync_releases(release_list, families, majors):
+	"""Newest release in each of the last majors main versions of families
+
+	families are family names like PanOS_5000, or readable names, which
+	select every family with that name.
+	"""
+	latest = latest_in_trains([release for release in release_list
+		if release[0] in families or release[4] in families])
+	trains = {}
+	for (family, main_version), release in latest.items():
+		trains.setdefault(family, []).append(release)
+	desired = []
+	for family in sorted(trains):
+		newest = sorted(trains[family], key=lambda release: version_key(release[1]), reverse=True)
+		desired.extend(newest[:majors])
+	return desired
+
+def batch_download(downloader, catalog, selectors, download_dir, workers, dry_run=False):
+	"""Download every release matching the selectors. Returns exit code"""
+	release_list = catalog.releases()
+	releases = []
+	for selector in selectors:
+		matches = select_releases(release_list, parse_selector(selector))
+		if not matches:
+			print "No releases match selector: %s" % selector
+		releases.extend(matches)
+	return download_releases(downloader, releases, download_dir, workers, dry_run)
+
+def sync(downloader, catalog, families, majors, download_dir, workers, dry_run=False):
+	"""Download the newest release of the last majors main versions of families. Returns exit code"""
+	releases = sync_releases(catalog.releases(), families, majors)
+	if not releases:
+		print "No releases found for: %s" % ", ".join(families)
+		return 1
+	return download_releases(downloader, releases, download_dir, workers, dry_run)
+
+def download_releases(downloader, releases, download_dir, workers, dry_run=False):
+	"""Download the releases that are not in download_dir yet, concurrently. Returns exit code"""
+	index = downloader.get_index(download_dir)
+	index.reconcile()
+	jobs = []
+	queued = set()
+	for release in releases:
+		filename = ContentDownloader.software_filename(release[3])
+		if filename in queued: continue
+		queued.add(filename)
+		if index.has("software", filename) or os.path.exists(os.path.join(download_dir, filename)):
+			print "Already downloaded: %s" % filename
+			continue
+		if dry_run: print "Would download: %s" % filename
+		jobs.append((release[3], filename))
+	if not jobs or dry_run: return 0
+	print "\nDownloading %d files to folder %s....." % (len(jobs), download_dir)
+	downloaded = downloader.download_files(download_dir, jobs, workers, ContentDownloader.DOWNLOAD_SEGMENTS,
+		ContentDownloader.PRIORITY_SOFTWARE)
+	for url, filename in jobs:
+		if filename in downloaded: print "%s has been downloaded" % filename
+		else: print "ERROR: unable to download %s" % filename
+	if len(downloaded) != len(jobs): return 1
+	return 0
+
+def build_main_menu(catalog):
+	quit_option = [0,"Quit"]
+	refresh_option = [1,"Refresh release information from download.paloaltonetworks.com"]
+	main_menu = [quit_option]
+	main_menu.append(refresh_option)
+	counter = 2
+	for readable_name in catalog.readable_names():
+		menu_item = [counter, readable_name]
+		main_menu.append(menu_item)
+		counter += 1
+	return main_menu
+
+def generate_sub_menu_1(catalog, selected_modell):
+	back_option = [0,"Back"]
+	quit_option = [1,"Quit"]
+	sub_menu_1 = [back_option]
+	sub_menu_1.append(quit_option)
+	counter = 2
+	for main_version in catalog.main_versions(selected_modell):
+		this_item = [counter,main_version]
+		sub_menu_1.append(this_item)
+		counter += 1
+	return sub_menu_1
+
+def generate_sub_menu_2(catalog, selected_main, selected_modell):
+	back_option = [0,"Back"]
+	quit_option = [1,"Quit"]
+	sub_menu_2 = [back_option]
+	sub_menu_2.append(quit_option)
+	counter = 2
+	for version, link in catalog.versions(selected_modell, selected_main):
+		this_item = [counter,version,link]
+		sub_menu_2.append(this_item)
+		counter += 1
+	return sub_menu_2
+
+def main():
+	# Get passed arguments
+	args = get_passed_arguments()
+	# Start logging
+	if args.loglevel:
+		if args.loglevel in LOGLEVELS: start_logging(args.loglevel)
+		else:
+			log_message = "Unsupported log leve set %s. Exiting...." % (args.loglevel)
+			logging.error(log_message)
+			if verbose: print log_message
+			sys.exit()
+	else: start_logging("INFO")  # INFO is default
+
+	#Parse config file
+	config = load_config(CONFIG_FILE)
+	username, password, download_dir = get_config(config)
+	ContentDownloader.throttle = get_throttle(config)
+	ContentDownloader.metrics = get_metrics(config)
+	ContentDownloader.store = get_store(config)
+	atexit.register(ContentDownloader.metrics.write_prometheus)
+
+	#Create contentdownloader
+	if args.loglevel == "DEBUG": debugenabled = True
+	else: debugenabled = False
+	SwDownloader = ContentDownloader(username=username, password=password, debug=debugenabled,
+		backend=get_backend(config), accounts=get_accounts(config))
+	usernames = ", ".join(account.username for account in SwDownloader.accounts)
+
+	#Open release catalog, and refresh it if missing or outdated
+	catalog = ReleaseCatalog(CATALOG_FILE)
+	if catalog.fetched() is None and catalog.import_cache_file(DATA_CACHE_FILE):
+		logging.info("Imported release information from %s" % DATA_CACHE_FILE)
+
+	#Non-interactive download of selected releases
+	if args.select or args.manifest:
+		selectors = list(args.select or [])
+		try:
+			if args.manifest: selectors.extend(read_manifest(args.manifest))
+			for selector in selectors: parse_selector(selector)
+		except (IOError, ValueError) as e:
+			print "ERROR: %s" % e
+			sys.exit(1)
+		#Always refresh, as download links in the catalog expire
+		print "\nRetrieving release information from downloads.paloaltonetworks.com..please wait"
+		if not try_refresh_catalog(SwDownloader, catalog): sys.exit(1)
+		sys.exit(batch_download(SwDownloader, catalog, selectors, download_dir, args.workers, args.dry_run))
+
+	#Download the latest releases of the selected families that are missing
+	if args.sync:
+		families = [family.strip() for family in args.sync.split(",") if family.strip()]
+		print "\nRetrieving release information from downloads.paloaltonetworks.com..please wait"
+		if not try_refresh_catalog(SwDownloader, catalog): sys.exit(1)
+		sys.exit(sync(SwDownloader, catalog, families, args.majors, download_dir, args.workers, args.dry_run))
+
+	if not catalog.is_stale(CATALOG_MAX_AGE):
+		print "\nRelease information succesfully retrieved from cache..."
+	else:
+		print "\nRelease information missing or outdated. Retrieving release information from downloads.paloaltonetworks.com..please wait"
+		print "\nNB! account(s) %s used to retrive files. You will only be able to download software accesible from these." % (usernames)
+		#The menu still works with the releases already in the catalog, if any
+		try_refresh_catalog(SwDownloader, catalog)
+
+	#Initial menu
+	while True:
+		# Generate main meny table
+		main_menu = build_main_menu(catalog)
+		#Print menu and catch user selection
+		print "\nDownload PAN-OS software from support.paloaltonetworks.com"
+		print "Please select which device to download software for:\n"
+		for option in main_menu:
+			print "%s - %s" %(option[0], option[1])
+		print ""
+		choice = input("Selection: ")
+		choice = int(choice)
+
+		if choice == 0: sys.exit() #Quit menu item
+		elif choice == 1: # Refresh menu item
+			print "\nRetrieving release information from downloads.paloaltonetworks.com..please wait"
+			print "NB! account(s) %s used to retrive files. You will only be able to download software accesible from these." % (usernames)
+			try_refresh_catalog(SwDownloader, catalog)
+		elif choice > len(main_menu)-1: print "Incorrect selection..please try again.."
+		else:
+			#Sub menu 1
+			selected_modell = main_menu[choice][1]
+			#Generate submenu
+			sub_menu_1 = generate_sub_menu_1(catalog, selected_modell)
+			#print main_releases
+			while True:
+				print "\nSelect PAN-OS main release:\n"
+				for main_release in sub_menu_1:
+					print "%s - %s" % (main_release[0], main_release[1])
+				print ""
+				choice_main_version = input("Selection: ")
+				choice_main_version = int(choice_main_version)
+				if choice_main_version == 0: break
+				if choice_main_version == 1: sys.exit()
+				if choice_main_version > len(sub_menu_1)-1: print "Incorrect selection..please try again.."
+				else:
+					selected_main = sub_menu_1[choice_main_version][1]
+
+					#Generate submenu2
+					sub_menu_2 = generate_sub_menu_2(catalog, selected_main, selected_modell)
+					while True:
+						print "\nAvailable releases for main release %s. Please select to download:\n" % (selected_main)
+						for item in sub_menu_2:
+							print "%s - %s" % (item[0], item[1])
+						print ""
+						choice_patch_version = input("Selection: ")
+						choice_patch_version = int(choice_patch_version)
+						if choice_patch_version == 0: break
+						if choice_patch_version == 1: sys.exit()
+						if choice_patch_version > len(sub_menu_2)-1: print "Incorrect selection..please try again.."
+						else:
+							download_release = sub_menu_2[choice_patch_version]
+							print "\nDownloading %s for %s from %s....." % (download_release[1], selected_modell, download_release[2])
+							try:
+								SwDownloader.download_software(download_dir,download_release[2])
+							except ChecksumError as e:
+								print "\nERROR: %s. The download has been discarded.\n" % (e)
+								continue
+							except REQUEST_ERRORS as e:
+								logging.error("Unable to download %s: %s" % (download_release[2], e))
+								print "\nERROR: unable to download %s: %s\n" % (download_release[1], e)
+								continue
+							print "\n%s has been downloaded to folder %s\n" % (download_release[1],download_dir)
+
+if __name__ == '__main__':
+	main()
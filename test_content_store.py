@@ -0,0 +1,55 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from content_downloader import ContentStore
+
+
+class SharedSymbolicStoreTest(unittest.TestCase):
+    """Two download directories linking to one store with symbolic links"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ContentStore(os.path.join(self.root, "store"), "symbolic")
+        self.mirrors = []
+        for name in ("mirror1", "mirror2"):
+            os.mkdir(os.path.join(self.root, name))
+            self.mirrors.append(os.path.join(self.root, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def download(self, directory, filename, data):
+        path = os.path.join(directory, filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        digest = hashlib.sha256(data).hexdigest()
+        self.store.add(path, digest)
+        return digest
+
+    def test_collect_keeps_objects_linked_from_other_directories(self):
+        shared = self.download(self.mirrors[0], "panupv2-all-contents-1-1", b"shared")
+        self.download(self.mirrors[1], "panupv2-all-contents-1-1", b"shared")
+        pruned = self.download(self.mirrors[0], "panupv2-all-contents-1-0", b"pruned")
+        os.remove(os.path.join(self.mirrors[0], "panupv2-all-contents-1-1"))
+        os.remove(os.path.join(self.mirrors[0], "panupv2-all-contents-1-0"))
+
+        # What prune() does after pruning the first mirror
+        self.assertEqual(self.store.collect([self.mirrors[0]]), 1)
+        self.assertTrue(self.store.has(shared))
+        self.assertFalse(self.store.has(pruned))
+        with open(os.path.join(self.mirrors[1], "panupv2-all-contents-1-1"), "rb") as f:
+            self.assertEqual(f.read(), b"shared")
+
+    def test_collect_keeps_objects_of_stores_without_recorded_directories(self):
+        digest = self.download(self.mirrors[1], "panupv2-all-contents-1-1", b"shared")
+        os.remove(self.store.directories_file)
+        self.store = ContentStore(self.store.directory, "symbolic")
+        self.assertEqual(self.store.collect([self.mirrors[0]]), 0)
+        self.assertTrue(self.store.has(digest))
+
+
+if __name__ == "__main__":
+    unittest.main()